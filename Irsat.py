@@ -25,11 +25,55 @@ import argparse
 import shutil
 import datetime
 import ConfigParser
+import hashlib
+import string
+import itertools
+import array
+import bisect
+import heapq
+import mmap
+import re
+import zlib
+import binascii
+import multiprocessing
+import threading
+import json
+import resource
+import errno
+import glob
+import time
+import collections
+import gzip
+import struct
+import signal
+import fcntl
+import traceback
 
 outDir = ""
 args = ""
 commands = ""
 lastContigsFile = ""
+mappingIndex = ""
+mappingReference = []
+mappingReadFiles = {}
+assemblyReadFiles = {}
+readIndex = {}
+readStore = {}
+recruitedReadCounts = {}
+finalIteration = None
+readChunks = {}
+sharedCandidateFiles = {}
+sharedTargetIndex = None
+scratchDir = None
+diskBudget = None
+currentStage = threading.local()
+metricsLock = threading.Lock()
+runningProcesses = set()
+processesLock = threading.Lock()
+pipelineStopping = threading.Event()
+complementTable = string.maketrans('ACGTNacgtn', 'TGCANtgcan')
+intermediateDirectories = ['0_prefilter', '1_mapping_index', '2-paired_read_alignments', '2-unpaired_read_alignments',
+                           '2-read_chunks', '2-normalised_reads', '3-assembly']
 
 def main():
     startTime = datetime.datetime.now()
@@ -39,6 +83,48 @@ def main():
     printStartMessage()
     readConfigFile()
     makeOutputDirectory()
+    makeScratchDirectory()
+
+    signal.signal(signal.SIGTERM, handleStopSignal)
+    try:
+        if args['samples'] is not None:
+            runSamplesInParallel()
+        else:
+            if args['read_store']:
+                buildReadStore()
+            if args['read_index']:
+                buildReadIndex()
+            if args['chunks'] > 0:
+                makeReadChunks()
+
+            if args['per_target']:
+                runTargetsInParallel()
+            else:
+                runIterations()
+    except KeyboardInterrupt:
+        stopRunningProcesses()
+        print '\n\nInterrupted.'
+        exit()
+    finally:
+        deleteScratchDirectory()
+
+    endTime = datetime.datetime.now()
+    duration = endTime - startTime
+    printFinishedMessage(duration)
+
+
+
+
+
+
+
+
+# Runs the assembly iterations for the current target and output directory
+# and returns the number of the last iteration run.
+def runIterations():
+    global args
+    global lastContigsFile
+    global finalIteration
 
     # For a new run, the starting iteration is 1,
     # but it can be higher if the user specified
@@ -46,33 +132,521 @@ def main():
     startIter = args['r'] + 1
     endIter = startIter + args['i']
 
-    for i in range(startIter, endIter):
-        iterStartTime = datetime.datetime.now()
-        iterDir = makeIterationDirectory(i)
-        printIterationMessage(i)
+    # When resuming, the previous iteration's contigs go into the first index.
+    if startIter > 1:
+        lastContigsFile = getIterationContigsFile(startIter - 1)
+
+    # With no iterations to run (-i 0), the last iteration is the one before.
+    lastIteration = startIter - 1
+
+    # A stage which fails gives back its place in the disk budget.
+    try:
+        for i in range(startIter, endIter):
+            lastIteration = i
+            iterStartTime = datetime.datetime.now()
+            iterDir = makeIterationDirectory(i)
+            printIterationMessage(i)
+
+            # The mapping stage covers everything from the index to the carry-
+            # forward.  If its checkpoint is valid, the index isn't needed.
+            setMappingReadFiles(i)
+            indexKey = getIndexStageKey(i, iterDir)
+            mappingKey = getMappingStageKey(i, iterDir, indexKey)
+            if isStageCheckpointed(iterDir, 'mapping', mappingKey):
+                print '   ' + getDateTimeString() + '  Mapping reads... reused (checkpoint)'
+            else:
+                clearStage(iterDir, 'mapping')
+                if isStageCheckpointed(iterDir, 'index', indexKey):
+                    restoreIndexState(iterDir)
+                    print '   ' + getDateTimeString() + '  Building Bowtie 2 index... reused (checkpoint)'
+                else:
+                    clearStage(iterDir, 'index')
+                    indexInputs = [args['t']] if i == 1 else [args['t'], lastContigsFile]
+                    metrics = startStageMetrics(i, 'index', indexInputs)
+                    compactionMetrics = buildBowtieIndex(i, iterDir)
+                    finishStageMetrics(metrics, [getWorkingDirectory(iterDir) + '/1_mapping_index'], compactionMetrics)
+                    saveStageCheckpoint(iterDir, 'index', indexKey, {'index': mappingIndex, 'reference': mappingReference})
+
+                # Chunked mapping excludes recruited reads and prefilters each
+                # chunk in its own worker.
+                if args['skip_recruited'] and i > 1 and mappingIndex is not None and not isMappingChunked():
+                    metrics = startStageMetrics(i, 'skip_recruited', mappingReadFiles.values())
+                    skipRecruitedReads(i, getWorkingDirectory(iterDir), getUnrecruitedReadsSources(i))
+                    finishStageMetrics(metrics, mappingReadFiles.values())
+
+                if args['prefilter'] > 0 and not isMappingChunked():
+                    metrics = startStageMetrics(i, 'prefilter', mappingReadFiles.values())
+                    prefilterReads(iterDir)
+                    finishStageMetrics(metrics, mappingReadFiles.values())
+
+                mapReads(i, iterDir)
+
+                previousReadsFiles = getFilteredReadsFiles(getIterationDirectoryFullPath(i - 1)) if i > 1 else []
+                metrics = startStageMetrics(i, 'carry_forward', getFilteredReadsFiles(iterDir) + previousReadsFiles)
+                if args['read_index']:
+                    updateRecruitedReads(i, iterDir)
+                elif i > 1:
+                    addPreviousReads(i, iterDir)
+                recruitedCount = countRecruitedReads(i)
+                finishStageMetrics(metrics, getFilteredReadsFiles(iterDir), {'recruited_reads': recruitedCount})
+                saveStageCheckpoint(iterDir, 'mapping', mappingKey, {'recruited_reads': recruitedCount})
+
+                # The index and the mapping's intermediate files aren't needed
+                # any more.
+                if not args['keep']:
+                    deleteTemporaryDirectories(iterDir, ['0_prefilter', '1_mapping_index', '2-paired_read_alignments', '2-unpaired_read_alignments', '2-read_chunks'])
+                    if i > 1:
+                        deleteUnrecruitedReads(getWorkingDirectory(getIterationDirectoryFullPath(i - 1)))
+
+            # In per-target runs, only the first iteration's mapping reads the
+            # shared candidates.
+            if i == 1 and not args['keep']:
+                deleteSharedCandidateFiles()
+
+            # If no new reads were recruited, the assembly would be the same as
+            # the last one (unless a profile changes the assembly command), so
+            # it is reused.  With --converge, the run then stops after this
+            # iteration, so it is the last.
+            readsUnchanged = i > 1 and getRecruitedReadCount(i) == getRecruitedReadCount(i - 1)
+            if args['converge'] and readsUnchanged:
+                finalIteration = i
+            setAssemblyReadFiles(iterDir)
+            runAssemblyStage(i, iterDir, readsUnchanged and getAssemblyCommandTemplate(i) == getAssemblyCommandTemplate(i - 1))
+
+            converged = hasConverged(i) or readsUnchanged
+
+            # A run which stops early hasn't used a profile for its last
+            # iteration yet, so if that would change the assembly command,
+            # this iteration is assembled again.
+            if args['converge'] and converged and finalIteration != i:
+                assemblyCommand = getAssemblyCommandTemplate(i)
+                finalIteration = i
+                if getAssemblyCommandTemplate(i) != assemblyCommand:
+                    print '   Assembling again with the commands for the last iteration:'
+                    runAssemblyStage(i, iterDir, False)
+
+            if not args['keep']:
+                deleteTemporaryDirectories(iterDir)
+
+            iterEndTime = datetime.datetime.now()
+            duration = iterEndTime - iterStartTime
+            print '   Time to complete iteration:', convertTimeDeltaToReadableString(duration)
+
+            if args['converge'] and converged:
+                print '\nThe assembly has stopped growing, so no more iterations will be run.'
+                break
+    finally:
+        abandonStageMetrics()
+
+    if not args['keep'] and lastIteration >= startIter:
+        deleteUnrecruitedReads(getWorkingDirectory(getIterationDirectoryFullPath(lastIteration)))
+
+    return lastIteration
+
+
+
+
+# Assembles an iteration's reads, or reuses the previous iteration's assembly,
+# unless the assembly stage's checkpoint is valid.
+def runAssemblyStage(iteration, iterDir, reuseAssembly):
+    global args
+    global lastContigsFile
+
+    assemblyKey = getAssemblyStageKey(iteration, iterDir, reuseAssembly)
+    if isStageCheckpointed(iterDir, 'assembly', assemblyKey):
+        lastContigsFile = getIterationContigsFile(iteration)
+        print '   ' + getDateTimeString() + '  Assembling... reused (checkpoint)'
+        return
+
+    clearStage(iterDir, 'assembly')
+    if args['normalise'] > 0 and not reuseAssembly:
+        metrics = startStageMetrics(iteration, 'normalise', getFilteredReadsFiles(iterDir))
+        keptCount = normaliseReads(iterDir)
+        finishStageMetrics(metrics, assemblyReadFiles.values(), {'kept_reads': keptCount})
+
+    metrics = startStageMetrics(iteration, 'assembly', assemblyReadFiles.values())
+    if reuseAssembly:
+        reusePreviousAssembly(iteration, iterDir)
+    else:
+        assemble(iteration, iterDir)
+    finishStageMetrics(metrics, [lastContigsFile], getAssemblyMetrics(lastContigsFile, reuseAssembly))
+    saveStageCheckpoint(iterDir, 'assembly', assemblyKey)
+
+    if not args['keep']:
+        deleteTemporaryDirectories(iterDir, ['2-normalised_reads', '3-assembly'])
+
+
+
+
+# In batch mode, each sample in the sample sheet gets its own output
+# directory and its own iterations, run in a pool of worker processes like
+# per-target mode.  The thread and memory budgets are split evenly between
+# the workers.  The first iteration's index only holds the target, so it is
+# the same for every sample and is built once, before the workers start.  At
+# the end, the samples' results are written to one summary file.
+def runSamplesInParallel():
+    global args
+    global outDir
+
+    samples = loadSampleSheet(args['samples'])
+    jobs = args['jobs']
+    if jobs == 0:
+        jobs = args['threads']
+    jobs = min(jobs, args['threads'], len(samples))
+    threadsPerJob = max(1, args['threads'] // jobs)
+    memoryPerJob = max(1, args['memory'] // jobs)
+
+    buildSharedTargetIndex()
+
+    print '\nRunning ' + str(len(samples)) + ' samples, ' + str(jobs) + ' at a time with ' + str(threadsPerJob) + ' thread' + ('s' if threadsPerJob > 1 else '') + ' and ' + str(memoryPerJob) + ' GB each:'
+    sys.stdout.flush()
+
+    pool = multiprocessing.Pool(jobs, initializer=prepareWorkerProcess, maxtasksperchild=1)
+    jobArguments = [(sampleName, readFiles, threadsPerJob, memoryPerJob) for sampleName, readFiles in samples]
+    results = {}
+    resultIterator = pool.imap_unordered(runSampleWorker, jobArguments)
+    for job in jobArguments:
+        try:
+            sampleName, summary = getNextResult(resultIterator)
+        except KeyboardInterrupt:
+            pool.terminate()
+            raise
+        if summary is None:
+            print '   ' + getDateTimeString() + '  ' + sampleName + ': failed (see ' + outDir + '/' + sampleName + '/irsat.log)'
+        else:
+            print '   ' + getDateTimeString() + '  ' + sampleName + ': ' + str(summary['iterations']) + ' iterations, ' + str(summary['recruited_reads']) + ' reads, ' + str(summary['contigs']) + ' contigs, ' + str(summary['total_length']) + ' bp'
+        sys.stdout.flush()
+        results[sampleName] = summary
+    pool.close()
+    pool.join()
+
+    if not args['keep'] and scratchDir is None:
+        shutil.rmtree(outDir + '/target_index')
+
+    summaryFile = outDir + '/batch_summary.tsv'
+    writeBatchSummary([(sampleName, results[sampleName]) for sampleName, readFiles in samples], summaryFile)
+    print '\nSummary: ' + summaryFile
+
+    if any(summary is None for summary in results.values()):
+        print '\nERROR: at least one sample failed.'
+        exit()
+
+
+# The sample sheet is tab-delimited, with one sample per line: a name, then
+# the first mate, second mate and unpaired read files.  A read file can be
+# left blank or given as '-'.  Blank lines and lines starting with '#' are
+# skipped.  Returns a list of (sample name, read files), where the read files
+# are keyed like the read arguments.
+def loadSampleSheet(sampleSheet):
+    samples = []
+    for line in open(sampleSheet, 'r'):
+        if line.strip() == '' or line.startswith('#'):
+            continue
+        parts = [part.strip() for part in line.rstrip('\n').split('\t')]
+        parts += [''] * (4 - len(parts))
+        readFiles = [None if part in ('', '-') else part for part in parts[1:4]]
+        samples.append((parts[0], {'1': readFiles[0], '2': readFiles[1], 'u': readFiles[2]}))
+    return samples
+
+
+# The target index is built in the working directory for the whole run, and
+# its output goes to OUTDIR/logs/target_index.log.
+def buildSharedTargetIndex():
+    global args
+    global outDir
+    global sharedTargetIndex
+
+    print '\nBuilding the target index:'
+    print '   ' + getDateTimeString() + '  Building Bowtie 2 index...',
+    sys.stdout.flush()
+
+    indexDir = getWorkingDirectory(outDir) + '/target_index'
+    if os.path.exists(indexDir):
+        shutil.rmtree(indexDir)
+    os.makedirs(indexDir)
+
+    currentStage.logFile = outDir + '/logs/target_index.log'
+    try:
+        if args['index_cache'] is not None:
+            cached = linkCachedIndex(args['t'], indexDir + '/bowtie2index', args['threads'])
+        else:
+            runIndexCommand(args['t'], indexDir + '/bowtie2index', args['threads'])
+            cached = False
+    finally:
+        currentStage.logFile = None
+
+    sharedTargetIndex = indexDir + '/bowtie2index'
+    print 'reused (index cache)' if cached else 'done'
+
+
+# Runs in a worker process, with a fresh copy of the global state for each
+# sample, like runTargetWorker.  The read index and read chunks (if used)
+# belong to the sample's reads, so they are made here, in the sample's
+# directory.
+def runSampleWorker(jobArguments):
+    global args
+    global outDir
+
+    sampleName, readFiles, threads, memory = jobArguments
+    outDir = outDir + '/' + sampleName
+    if not os.path.exists(outDir):
+        os.makedirs(outDir)
+    args['1'] = readFiles['1']
+    args['2'] = readFiles['2']
+    args['u'] = readFiles['u']
+    args['threads'] = threads
+    args['memory'] = memory
+
+    sys.stdout = open(outDir + '/irsat.log', 'a', 1)
+    try:
+        if args['read_store']:
+            buildReadStore()
+        if args['read_index']:
+            buildReadIndex()
+        if args['chunks'] > 0:
+            makeReadChunks()
+        lastIteration = runIterations()
+        return sampleName, getSampleSummary(lastIteration)
+    except SystemExit:
+        return sampleName, None
+    finally:
+        abandonStageMetrics()
+        sys.stdout.close()
+        sys.stdout = sys.__stdout__
+
+
+def getSampleSummary(lastIteration):
+    contigLengths = []
+    if lastIteration > 0:
+        contigLengths = [len(sequence) for name, sequence in loadFasta(getIterationContigsFile(lastIteration))]
+    summary = collections.OrderedDict()
+    summary['iterations'] = lastIteration
+    summary['recruited_reads'] = getRecruitedReadCount(lastIteration) if lastIteration > 0 else 0
+    summary['contigs'] = len(contigLengths)
+    summary['total_length'] = sum(contigLengths)
+    summary['longest_contig'] = max(contigLengths + [0])
+    summary['n50'] = getN50(contigLengths)
+    return summary
+
+
+# Failed samples are listed with a status of 'failed' and no results.
+def writeBatchSummary(results, summaryFile):
+    columns = ['iterations', 'recruited_reads', 'contigs', 'total_length', 'longest_contig', 'n50']
+    summaryOutput = open(summaryFile, 'w')
+    summaryOutput.write('\t'.join(['sample', 'status'] + columns) + '\n')
+    for sampleName, summary in results:
+        if summary is None:
+            summaryOutput.write('\t'.join([sampleName, 'failed'] + [''] * len(columns)) + '\n')
+        else:
+            summaryOutput.write('\t'.join([sampleName, 'done'] + [str(summary[column]) for column in columns]) + '\n')
+    summaryOutput.close()
+
+
+
+# In per-target mode, each target sequence gets its own output directory
+# and its own iterations, run in a pool of worker processes.  The thread
+# budget is split evenly between the workers.  The read index (if used) is
+# built once before the workers start and with --prefilter, the input reads
+# are streamed once to find the first iteration's candidates for all targets.
+def runTargetsInParallel():
+    global args
+    global outDir
+
+    targets = splitTargets()
+    jobs = args['jobs']
+    if jobs == 0:
+        jobs = args['threads']
+    jobs = min(jobs, args['threads'], len(targets))
+    threadsPerJob = max(1, args['threads'] // jobs)
+    memoryPerJob = max(1, args['memory'] // jobs)
+
+    if args['prefilter'] > 0:
+        writeSharedTargetCandidates(targets)
+
+    print '\nRunning ' + str(len(targets)) + ' targets, ' + str(jobs) + ' at a time with ' + str(threadsPerJob) + ' thread' + ('s' if threadsPerJob > 1 else '') + ' each:'
+    sys.stdout.flush()
+
+    pool = multiprocessing.Pool(jobs, initializer=prepareWorkerProcess, maxtasksperchild=1)
+    jobArguments = [(targetName, targetFile, threadsPerJob, memoryPerJob) for targetName, targetFile in targets]
+    results = []
+    resultIterator = pool.imap_unordered(runTargetWorker, jobArguments)
+    for job in jobArguments:
+        try:
+            result = getNextResult(resultIterator)
+        except KeyboardInterrupt:
+            pool.terminate()
+            raise
+        targetName, lastIteration, contigCount, contigLength = result
+        if lastIteration is None:
+            print '   ' + getDateTimeString() + '  ' + targetName + ': failed (see ' + outDir + '/' + targetName + '/irsat.log)'
+        else:
+            print '   ' + getDateTimeString() + '  ' + targetName + ': ' + str(lastIteration) + ' iterations, ' + str(contigCount) + ' contigs, ' + str(contigLength) + ' bp'
+        sys.stdout.flush()
+        results.append(result)
+    pool.close()
+    pool.join()
+
+    if any(result[1] is None for result in results):
+        print '\nERROR: at least one target failed.'
+        exit()
+
+
+
+# Runs in a worker process.  The worker has its own copy of the global state
+# (a fresh one for each target), so it just points that at its own target and
+# output directory.  Its output goes to a log file in its directory instead of
+# the terminal.
+def runTargetWorker(jobArguments):
+    global args
+    global outDir
+    global sharedCandidateFiles
+
+    targetName, targetFile, threads, memory = jobArguments
+    outDir = outDir + '/' + targetName
+    args['t'] = targetFile
+    args['threads'] = threads
+    args['memory'] = memory
+    sharedCandidateFiles = getSharedCandidateFiles(outDir)
+
+    sys.stdout = open(outDir + '/irsat.log', 'a', 1)
+    try:
+        lastIteration = runIterations()
+        if lastIteration == 0:
+            return targetName, lastIteration, 0, 0
+        contigCount, contigLength, contigSetHash = getContigStats(getIterationContigsFile(lastIteration))
+        return targetName, lastIteration, contigCount, contigLength
+    except SystemExit:
+        return targetName, None, 0, 0
+    finally:
+        abandonStageMetrics()
+        sys.stdout.close()
+        sys.stdout = sys.__stdout__
+
+
+
+# Saves each target sequence to its own FASTA file in its own output
+# directory and returns a list of (target name, FASTA file).
+def splitTargets():
+    global args
+    global outDir
+
+    targets = []
+    usedNames = set()
+    for name, sequence in loadFasta(args['t']):
+        targetName = re.sub(r'[^A-Za-z0-9_.-]', '_', name.split()[0]) if name.strip() != '' else 'target'
+        uniqueName = targetName
+        suffix = 2
+        while uniqueName in usedNames:
+            uniqueName = targetName + '_' + str(suffix)
+            suffix += 1
+        usedNames.add(uniqueName)
 
-        buildBowtieIndex(i, iterDir)
+        targetDir = outDir + '/' + uniqueName
+        if not os.path.exists(targetDir):
+            os.makedirs(targetDir)
+        targetFile = targetDir + '/target.fasta'
+        saveFasta([(name, sequence)], targetFile)
+        targets.append((uniqueName, targetFile))
+    return targets
 
+
+
+def getSharedCandidateFiles(targetDir):
+    global args
+
+    candidateFiles = {}
+    if args['prefilter'] > 0:
         if args['1'] != None and args['2'] != None:
-            mapPairedReads(i, iterDir)
+            candidateFiles['1'] = targetDir + '/shared_candidates_R1.fastq'
+            candidateFiles['2'] = targetDir + '/shared_candidates_R2.fastq'
         if args['u'] != None:
-            mapUnpairedReads(i, iterDir)
+            candidateFiles['u'] = targetDir + '/shared_candidates_U.fastq'
+    return candidateFiles
 
-        if i > 1:
-            addPreviousReads(i, iterDir)
 
-        assemble(i, iterDir)
+def deleteSharedCandidateFiles():
+    global sharedCandidateFiles
 
-        if not args['keep']:
-            deleteTemporaryDirectories(iterDir)
+    for candidateFile in sharedCandidateFiles.values():
+        if os.path.isfile(candidateFile):
+            os.remove(candidateFile)
 
-        iterEndTime = datetime.datetime.now()
-        duration = iterEndTime - iterStartTime
-        print '   Time to complete iteration:', convertTimeDeltaToReadableString(duration)
 
-    endTime = datetime.datetime.now()
-    duration = endTime - startTime
-    printFinishedMessage(duration)
+
+# Streams the input reads once and writes each read (or pair) to the
+# candidate files of every target it shares a k-mer with.  These are used as
+# the input for each target's first iteration, so the targets don't each
+# need to read the whole input at the start.
+def writeSharedTargetCandidates(targets):
+    global args
+    global outDir
+
+    print '\n' + getDateTimeString() + '  Prefiltering reads for all targets...',
+    sys.stdout.flush()
+
+    kmerSize = args['prefilter']
+    step = args['seed_length'] - kmerSize + 1
+
+    # Each k-mer maps to the index of the target it came from, or to a tuple
+    # of indices if it is in more than one target.
+    kmerTargets = {}
+    for targetIndex, (targetName, targetFile) in enumerate(targets):
+        for kmer in makeKmerSet([targetFile], kmerSize):
+            existing = kmerTargets.get(kmer)
+            if existing is None:
+                kmerTargets[kmer] = targetIndex
+            elif existing != targetIndex:
+                existingTuple = existing if isinstance(existing, tuple) else (existing,)
+                if targetIndex not in existingTuple:
+                    kmerTargets[kmer] = existingTuple + (targetIndex,)
+
+    candidateFiles = [getSharedCandidateFiles(outDir + '/' + targetName) for targetName, targetFile in targets]
+
+    if args['1'] != None and args['2'] != None:
+        outputs1 = [open(files['1'], 'w') for files in candidateFiles]
+        outputs2 = [open(files['2'], 'w') for files in candidateFiles]
+        for batch1, batch2 in zip(readFastqBatches(args['1']), readFastqBatches(args['2'])):
+            for record1, record2 in zip(batch1, batch2):
+                matchingTargets = getReadKmerTargets(record1[1], kmerTargets, kmerSize, step)
+                matchingTargets.update(getReadKmerTargets(record2[1], kmerTargets, kmerSize, step))
+                for targetIndex in matchingTargets:
+                    outputs1[targetIndex].write(''.join(record1))
+                    outputs2[targetIndex].write(''.join(record2))
+        for output in outputs1 + outputs2:
+            output.close()
+
+    if args['u'] != None:
+        outputsU = [open(files['u'], 'w') for files in candidateFiles]
+        for batch in readFastqBatches(args['u']):
+            for record in batch:
+                for targetIndex in getReadKmerTargets(record[1], kmerTargets, kmerSize, step):
+                    outputsU[targetIndex].write(''.join(record))
+        for output in outputsU:
+            output.close()
+
+    print 'done'
+
+
+
+# Like readSharesKmer, but returns the set of targets the read shares k-mers
+# with, so every k-mer position has to be checked.
+def getReadKmerTargets(sequenceLine, kmerTargets, kmerSize, step):
+    matchingTargets = set()
+    lastStart = len(sequenceLine.rstrip()) - kmerSize
+    if lastStart < 0:
+        return matchingTargets
+    starts = range(0, lastStart + 1, step)
+    if starts[-1] != lastStart:
+        starts.append(lastStart)
+    for i in starts:
+        targetIndices = kmerTargets.get(sequenceLine[i:i+kmerSize].upper())
+        if targetIndices is None:
+            continue
+        if isinstance(targetIndices, tuple):
+            matchingTargets.update(targetIndices)
+        else:
+            matchingTargets.add(targetIndices)
+    return matchingTargets
 
 
 
@@ -123,17 +697,132 @@ def getArguments():
 
     optional.add_argument("-r", metavar="RESUME",
                           type=int,
-                          help="Resume an existing Irsat run starting with this iteration",
+                          help="Resume an existing Irsat run after this iteration (stages with valid checkpoints are reused either way)",
+                          default=0)
+
+    optional.add_argument("--scratch", metavar="SCRATCH",
+                          help="put intermediate files (indices, alignments, assembler working files) in this directory, e.g. on a local disk, instead of in OUTDIR")
+
+    optional.add_argument("--disk_limit", metavar="GB",
+                          type=float,
+                          help="pause stages while the intermediate files (in SCRATCH, or OUTDIR without --scratch) would go over this many gigabytes (default: 0 = no limit)",
+                          default=0.0)
+
+    optional.add_argument("--index_cache", metavar="CACHE",
+                          nargs='?', const='~/.cache/irsat/indices',
+                          help="reuse the target index from this cache directory if the same target was indexed with the same command before, or build it and add it to the cache (default without CACHE: ~/.cache/irsat/indices)")
+
+    optional.add_argument("--index_cache_size", metavar="GB",
+                          type=float,
+                          help="with --index_cache, delete the least recently used indices when the cache is bigger than this (default: 10)",
+                          default=10.0)
+
+    optional.add_argument("--no_checkpoints",
+                          help="don't reuse or record stage checkpoints, so every stage of every iteration is run from scratch",
+                          action="store_true")
+
+    optional.add_argument("--delta_index",
+                          help="after the first iteration, only index contig regions that are new since the previous iteration, with a read length of older sequence on each side (reads matching older sequence are already carried forward)",
+                          action="store_true")
+
+    optional.add_argument("--compact",
+                          help="before each index is built, drop contigs which are duplicates of, or contained in, the target or a longer contig",
+                          action="store_true")
+
+    optional.add_argument("--min_contig_length", metavar="LENGTH",
+                          type=int,
+                          help="with --compact, also drop contigs shorter than this (default: 0)",
+                          default=0)
+
+    optional.add_argument("--frontier", metavar="WINDOW",
+                          type=int,
+                          help="after the first iteration, index only the target and WINDOW bp at each end of each contig, dropping ends which have stopped growing (default: 0 = off)",
+                          default=0)
+
+    optional.add_argument("--prefilter", metavar="K",
+                          type=int,
+                          help="before mapping, drop reads (and pairs) which share no K-mer with the mapping reference (default: 0 = off)",
+                          default=0)
+
+    optional.add_argument("--seed_length", metavar="LENGTH",
+                          type=int,
+                          help="the seed length used by the mapper (e.g. Bowtie 2's -L), which must be at least K for --prefilter to keep every read the mapper could align (default: 20)",
+                          default=20)
+
+    optional.add_argument("--skip_recruited",
+                          help="after the first iteration, only map reads (and pairs) which haven't been recruited yet, as recruited reads are carried forward anyway",
+                          action="store_true")
+
+    optional.add_argument("--stream_filter",
+                          help="filter the mapper's SAM output in a single streaming pass, without Samtools or Bedtools",
+                          action="store_true")
+
+    optional.add_argument("--read_store",
+                          help="pack the gzipped input reads once into a 2-bit read store, which is scanned instead of the input files by Irsat's own passes over the reads",
+                          action="store_true")
+
+    optional.add_argument("--read_index",
+                          help="index the byte offsets of the input reads once, track recruited reads in a bitmap and extract them from the input files in their original order",
+                          action="store_true")
+
+    optional.add_argument("--normalise", metavar="DEPTH",
+                          type=int,
+                          help="before assembly, drop reads (and pairs) whose median k-mer coverage is already above DEPTH (default: 0 = off)",
+                          default=0)
+
+    optional.add_argument("--normalise_k", metavar="K",
+                          type=int,
+                          help="the k-mer size used by --normalise (default: 20)",
+                          default=20)
+
+    optional.add_argument("--converge",
+                          help="stop before the last iteration if the recruited reads or the contigs stop changing",
+                          action="store_true")
+
+    optional.add_argument("--min_growth", metavar="PERCENT",
+                          type=float,
+                          help="with --converge, also stop when both the recruited read count and the total contig length grow by no more than this percentage in an iteration (default: 0.0)",
+                          default=0.0)
+
+    optional.add_argument("--threads", metavar="THREADS",
+                          type=int,
+                          help="the total number of threads to use, which replaces THREADS in the configured commands (default: the number of CPUs)",
+                          default=multiprocessing.cpu_count())
+
+    optional.add_argument("--per_target",
+                          help="run a separate, independent set of iterations for each target sequence, in parallel",
+                          action="store_true")
+
+    optional.add_argument("--jobs", metavar="JOBS",
+                          type=int,
+                          help="with --per_target or --samples, how many targets or samples are run at once, up to the number of threads (default: as many as there are threads, up to the number of targets or samples)",
+                          default=0)
+
+    optional.add_argument("--samples", metavar="SHEET",
+                          help="run every sample in this tab-delimited sample sheet (name, first mate, second mate and unpaired read files) in its own subdirectory of OUTDIR, in parallel, instead of the reads given with -1, -2 and -u")
+
+    optional.add_argument("--memory", metavar="GB",
+                          type=int,
+                          help="the total memory to use in gigabytes, which replaces MEMORY in the configured assembly commands (default: all of the machine's memory)",
+                          default=0)
+
+    optional.add_argument("--chunks", metavar="CHUNKS",
+                          type=int,
+                          help="split the input reads into this many chunks (once, for all iterations) and map the chunks in separate worker processes (default: 0 = off)",
                           default=0)
 
+    optional.add_argument("--compress",
+                          help="keep the filtered read files gzipped (compressed with pigz or bgzip if either is installed)",
+                          action="store_true")
+
     reads.add_argument("-1", metavar="FIRST",
-                       help="file of first reads in pair")
+                       help="file of first reads in pair (FASTQ, may be gzipped)")
 
     reads.add_argument("-2", metavar="SECOND",
-                       help="file of second reads in pair")
+                       help="file of second reads in pair (FASTQ, may be gzipped)")
 
     reads.add_argument("-u", metavar="UNPAIRED",
-                       help="file of unpaired reads")
+                       help="file of unpaired reads (FASTQ, may be gzipped)")
 
 
     return parser.parse_args()
@@ -142,28 +831,127 @@ def getArguments():
 def checkArguments():
     global args
 
-    if args['1'] == None and args['2'] == None and args['u'] == None:
-        print 'You must specify files for either paired-end reads, unparied reads or both.'
+    if args['samples'] is None:
+        checkReadFiles(args, '')
+    else:
+        checkSampleSheet()
+
+    if not os.path.isfile(args['t']):
+        print 'The target file could not be found.'
+        exit()
+
+    if args['threads'] < 1:
+        print 'At least one thread is required.'
         exit()
-    if (args['1'] == None and args['2'] != None):
-        print 'If a second mate file is given, then a first mate file is also required.'
+    if args['jobs'] < 0:
+        print 'The number of jobs cannot be negative.'
         exit()
-    if (args['1'] != None and args['2'] == None):
-        print 'If a first mate file is given, then a second mate file is also required.'
+
+    if args['min_growth'] < 0.0:
+        print 'The minimum growth percentage cannot be negative.'
         exit()
 
-    if args['1'] != None and not os.path.isfile(args['1']):
-        print 'The first mate file could not be found.'
+    if args['prefilter'] < 0:
+        print 'The prefilter k-mer size cannot be negative.'
         exit()
-    if args['2'] != None and not os.path.isfile(args['2']):
-        print 'The second mate file could not be found.'
+    if args['prefilter'] > args['seed_length']:
+        print 'The prefilter k-mer size cannot be larger than the seed length.'
         exit()
-    if args['u'] != None and not os.path.isfile(args['u']):
-        print 'The unpaired file could not be found.'
+
+    if args['chunks'] < 0:
+        print 'The number of chunks cannot be negative.'
         exit()
-    if not os.path.isfile(args['t']):
-        print 'The target file could not be found.'
+
+    if args['frontier'] < 0:
+        print 'The frontier window cannot be negative.'
+        exit()
+
+    if args['disk_limit'] < 0.0:
+        print 'The disk limit cannot be negative.'
+        exit()
+
+    if args['index_cache_size'] < 0.0:
+        print 'The index cache size cannot be negative.'
+        exit()
+
+    if args['memory'] < 0:
+        print 'The memory cannot be negative.'
+        exit()
+    if args['memory'] == 0:
+        args['memory'] = getTotalMemoryGigabytes()
+
+    if args['min_contig_length'] < 0:
+        print 'The minimum contig length cannot be negative.'
+        exit()
+
+    if args['normalise'] < 0:
+        print 'The normalisation depth cannot be negative.'
+        exit()
+    if args['normalise_k'] < 1:
+        print 'The normalisation k-mer size must be at least 1.'
+        exit()
+
+
+# Checks one set of read files, keyed like the read arguments.  In batch mode,
+# the messages start with the sample's name.
+def checkReadFiles(readFiles, messagePrefix):
+    if readFiles['1'] == None and readFiles['2'] == None and readFiles['u'] == None:
+        print messagePrefix + 'You must specify files for either paired-end reads, unparied reads or both.'
+        exit()
+    if (readFiles['1'] == None and readFiles['2'] != None):
+        print messagePrefix + 'If a second mate file is given, then a first mate file is also required.'
+        exit()
+    if (readFiles['1'] != None and readFiles['2'] == None):
+        print messagePrefix + 'If a first mate file is given, then a second mate file is also required.'
+        exit()
+
+    if readFiles['1'] != None and not os.path.isfile(readFiles['1']):
+        print messagePrefix + 'The first mate file could not be found.'
+        exit()
+    if readFiles['2'] != None and not os.path.isfile(readFiles['2']):
+        print messagePrefix + 'The second mate file could not be found.'
+        exit()
+    if readFiles['u'] != None and not os.path.isfile(readFiles['u']):
+        print messagePrefix + 'The unpaired file could not be found.'
+        exit()
+
+    for readsFile, description in ((readFiles['1'], 'first mate'), (readFiles['2'], 'second mate'), (readFiles['u'], 'unpaired')):
+        if readsFile != None and not isFastqFile(readsFile):
+            print messagePrefix + 'The ' + description + ' file does not look like a FASTQ file (plain or gzipped).'
+            exit()
+
+
+def checkSampleSheet():
+    global args
+
+    if args['1'] != None or args['2'] != None or args['u'] != None:
+        print 'Read files cannot be given with -1, -2 or -u as well as in a sample sheet.'
+        exit()
+    if args['per_target']:
+        print 'A sample sheet cannot be used with --per_target.'
         exit()
+    if not os.path.isfile(args['samples']):
+        print 'The sample sheet could not be found.'
+        exit()
+
+    samples = loadSampleSheet(args['samples'])
+    if len(samples) == 0:
+        print 'The sample sheet has no samples.'
+        exit()
+    sampleNames = set()
+    for sampleName, readFiles in samples:
+        if re.match(r'^[A-Za-z0-9_.-]+$', sampleName) is None or sampleName in ('.', '..'):
+            print 'Sample names can only contain letters, numbers, underscores, dots and dashes: ' + sampleName
+            exit()
+        if sampleName in sampleNames:
+            print 'The sample sheet has more than one sample named ' + sampleName + '.'
+            exit()
+        sampleNames.add(sampleName)
+        checkReadFiles(readFiles, 'Sample ' + sampleName + ': ')
+
+
+def getTotalMemoryGigabytes():
+    return max(1, os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // 1000000000)
 
 
 def readConfigFile():
@@ -181,29 +969,129 @@ def readConfigFile():
 
     commands = {}
 
-    if config.has_option('Mapping', 'paired reads'):
-        commands['map_paired'] = config.get('Mapping', 'paired reads').strip().split()
-
-    if config.has_option('Mapping', 'unpaired reads'):
-        commands['map_unpaired'] = config.get('Mapping', 'unpaired reads').strip().split()
-
-    if config.has_option('Assembly', 'paired reads'):
-        commands['assemble_paired'] = config.get('Assembly', 'paired reads').strip().splitlines()
-        commands['assemble_paired'][:] = [line.split() for line in commands['assemble_paired']]
-
-    if config.has_option('Assembly', 'unpaired reads'):
-        commands['assemble_unpaired'] = config.get('Assembly', 'unpaired reads').strip().splitlines()
-        commands['assemble_unpaired'][:] = [line.split() for line in commands['assemble_unpaired']]
+    # The index command is optional, for older config files.
+    commands['index'] = ['bowtie2-build', 'REFERENCE_FILES', 'INDEX']
+    if config.has_option('Mapping', 'index'):
+        commands['index'] = config.get('Mapping', 'index').strip().split()
 
-    if config.has_option('Assembly', 'both'):
-        commands['assemble_both'] = config.get('Assembly', 'both').strip().splitlines()
-        commands['assemble_both'][:] = [line.split() for line in commands['assemble_both']]
+    commands.update(getConfigCommands(config, 'Mapping'))
+    commands.update(getConfigCommands(config, 'Assembly'))
 
     if config.has_option('Assembly', 'contigs'):
         commands['assemble_contigs'] = config.get('Assembly', 'contigs').strip()
     if config.has_option('Assembly', 'graph'):
         commands['assemble_graph'] = config.get('Assembly', 'graph').strip()
 
+    # Sections like [Assembly: last] are profiles which override the mapping
+    # or assembly commands in some iterations.
+    commands['profiles'] = []
+    for section in config.sections():
+        if ':' not in section:
+            continue
+        stage, rules = [part.strip() for part in section.split(':', 1)]
+        if stage not in configCommandNames:
+            print "\nERROR: the configuration file section [" + section + "] isn't for Mapping or Assembly.\n"
+            exit()
+        for option in config.options(section):
+            if option not in configCommandNames[stage]:
+                print "\nERROR: the " + option + " option can't be used in the configuration file section [" + section + "].\n"
+                exit()
+        profile = getConfigCommands(config, section, stage)
+        profile['conditions'] = getProfileConditions(rules, section)
+        commands['profiles'].append(profile)
+
+
+# The configuration file options which hold the mapping and assembly commands,
+# and the names they are kept under in the commands dictionary.
+configCommandNames = {'Mapping': {'paired reads': 'map_paired',
+                                  'unpaired reads': 'map_unpaired'},
+                      'Assembly': {'paired reads': 'assemble_paired',
+                                   'unpaired reads': 'assemble_unpaired',
+                                   'both': 'assemble_both'}}
+
+
+# Mapping commands are one line.  Assembly commands can be several lines, so
+# they are lists of lines.
+def getConfigCommands(config, section, stage=None):
+    if stage is None:
+        stage = section
+
+    sectionCommands = {}
+    for option, commandName in configCommandNames[stage].items():
+        if not config.has_option(section, option):
+            continue
+        if stage == 'Mapping':
+            sectionCommands[commandName] = config.get(section, option).strip().split()
+        else:
+            sectionCommands[commandName] = [line.split() for line in config.get(section, option).strip().splitlines()]
+    return sectionCommands
+
+
+# A profile's rules are separated by commas, and the profile is used in an
+# iteration which meets all of them:
+#   first, last                    the first or last iteration of the run
+#   iteration 3, iterations 1-3    an iteration number or range (a range can
+#                                  be left open, like iterations 4-)
+#   reads < 50000                  the number of recruited reads, compared
+#                                  with <, <=, > or >=
+def getProfileConditions(rules, section):
+    conditions = []
+    for rule in rules.split(','):
+        rule = rule.strip()
+        iterationsMatch = re.match(r'^iterations?\s+(\d+)\s*(-)?\s*(\d*)$', rule)
+        readsMatch = re.match(r'^reads\s*(<=|>=|<|>)\s*(\d+)$', rule)
+        if rule in ('first', 'last'):
+            conditions.append((rule,))
+        elif iterationsMatch:
+            firstIteration = int(iterationsMatch.group(1))
+            lastIteration = firstIteration
+            if iterationsMatch.group(2):
+                lastIteration = int(iterationsMatch.group(3)) if iterationsMatch.group(3) else None
+            conditions.append(('iterations', firstIteration, lastIteration))
+        elif readsMatch:
+            conditions.append(('reads', readsMatch.group(1), int(readsMatch.group(2))))
+        else:
+            print "\nERROR: the rule '" + rule + "' in the configuration file section [" + section + "] wasn't understood.\n"
+            exit()
+    return conditions
+
+
+# Returns a mapping or assembly command for an iteration: the command from
+# the first profile in the configuration file which matches the iteration and
+# has that command, or else the command from the Mapping or Assembly section.
+# Mapping rules on reads use the reads recruited so far (by the previous
+# iteration), and assembly rules use the reads recruited for this assembly.
+# The last iteration is the one set by -i, or the one a run stopped by
+# --converge ends with (finalIteration).
+def getIterationCommand(commandName, iteration):
+    global args
+    global commands
+
+    readCount = None
+    for profile in commands['profiles']:
+        if commandName not in profile:
+            continue
+        matches = True
+        for condition in profile['conditions']:
+            if condition[0] == 'first':
+                matches = iteration == 1
+            elif condition[0] == 'last':
+                matches = iteration == args['r'] + args['i'] or iteration == finalIteration
+            elif condition[0] == 'iterations':
+                matches = iteration >= condition[1] and (condition[2] is None or iteration <= condition[2])
+            else:
+                if readCount is None:
+                    readCountIteration = iteration - 1 if commandName.startswith('map_') else iteration
+                    readCount = getRecruitedReadCount(readCountIteration) if readCountIteration > 0 else 0
+                comparison, limit = condition[1], condition[2]
+                matches = {'<': readCount < limit, '<=': readCount <= limit,
+                           '>': readCount > limit, '>=': readCount >= limit}[comparison]
+            if not matches:
+                break
+        if matches:
+            return profile[commandName]
+    return commands.get(commandName)
+
 
 # Commands exist as lists where each component separated by a space is its
 # own item.  There are variables in the commands like DIRECTORY that will
@@ -218,7 +1106,7 @@ def replacePartOfCommand(command, find, replace):
     return returnCommand
 
 def makeOutputDirectory():
-    fullOutPath = os.getcwd() + '/' + args['o'] + '/'
+    fullOutPath = os.path.abspath(args['o']) + '/'
 
     global outDir
     outDir = os.path.dirname(fullOutPath)
@@ -227,6 +1115,53 @@ def makeOutputDirectory():
         os.makedirs(outDir)
 
 
+# With --scratch, intermediate files go in a directory for this output
+# directory in the scratch directory, so a faster local disk can take the
+# index, alignments and assembler working files.  The name comes from the
+# output directory, so a resumed run uses the same one.  With --disk_limit,
+# the disk budget is set up here, before any worker processes are started,
+# so they all share it.
+def makeScratchDirectory():
+    global args
+    global outDir
+    global scratchDir
+    global diskBudget
+
+    if args['scratch'] is not None:
+        scratchDir = os.path.abspath(args['scratch']) + '/irsat_' + hashlib.md5(outDir).hexdigest()[:12]
+        if not os.path.exists(scratchDir):
+            os.makedirs(scratchDir)
+
+    if args['disk_limit'] > 0.0:
+        budgetDir = scratchDir if scratchDir is not None else outDir
+        diskBudget = DiskBudget(budgetDir, int(args['disk_limit'] * 1000000000))
+
+
+def deleteScratchDirectory():
+    global args
+    global scratchDir
+
+    if scratchDir is None or not os.path.exists(scratchDir):
+        return
+    if args['keep']:
+        print '\nIntermediate files were kept in ' + scratchDir
+    else:
+        shutil.rmtree(scratchDir)
+
+
+# Intermediate files for an iteration (or a chunk) go in its working
+# directory.  That's the iteration directory itself, unless there is a
+# scratch directory, which is laid out like the output directory.
+def getWorkingDirectory(directory):
+    global args
+    global scratchDir
+
+    directory = directory.rstrip('/')
+    if scratchDir is None or directory.startswith(scratchDir + '/'):
+        return directory
+    return scratchDir + '/' + os.path.relpath(directory, os.path.abspath(args['o']))
+
+
 
 
 
@@ -234,12 +1169,15 @@ def makeIterationDirectory(iteration):
     fullIterationPath = getIterationDirectoryFullPath(iteration)
     iterDir = os.path.dirname(fullIterationPath)
 
-    # If the iteration directory already exists, delete
-    # it, along with all of its contents.
-    if os.path.exists(iterDir):
+    # If the iteration directory already exists, its stages are checked
+    # against their checkpoints, and only invalid stages are cleared and run
+    # again.  Without checkpoints, it is deleted along with all of its
+    # contents.
+    if os.path.exists(iterDir) and args['no_checkpoints']:
         shutil.rmtree(iterDir)
 
-    os.makedirs(iterDir)
+    if not os.path.exists(iterDir):
+        os.makedirs(iterDir)
     return iterDir
 
 
@@ -264,161 +1202,1556 @@ def printIterationMessage(iteration):
 # the most current assembly (n/a for first iteration)
 def buildBowtieIndex(iteration, iterDir):
     global args
+    global commands
     global lastContigsFile
+    global mappingIndex
+    global mappingReference
 
     print '   ' + getDateTimeString() + '  Building Bowtie 2 index...',
     sys.stdout.flush()
 
     # Make a folder for the index
-    indexDir = iterDir + '/1_mapping_index'
+    indexDir = getWorkingDirectory(iterDir) + '/1_mapping_index'
     os.makedirs(indexDir)
 
+    # In batch mode, the first iteration uses the target index shared by all
+    # samples.  A delta index still records the target as indexed.
+    if iteration == 1 and sharedTargetIndex is not None:
+        if args['delta_index']:
+            writeNewSequencesForIndex(iteration, iterDir, indexDir, '')
+        mappingIndex = sharedTargetIndex
+        mappingReference = [args['t']]
+        print 'shared target index'
+        return None
+
+    # Contigs which would add nothing to the index are dropped first.
+    contigsFile = lastContigsFile
+    compactionMetrics = None
+    if args['compact'] and iteration > 1 and contigsFile != '':
+        contigsFile, compactionMetrics = writeCompactedContigs(iterDir, indexDir, contigsFile)
+
+    # In frontier mode, the contigs are replaced by their ends.
+    if args['frontier'] > 0 and iteration > 1:
+        contigsFile = writeFrontierSequences(iteration, iterDir, indexDir, contigsFile)
+
     inputFiles = args['t']
-    if iteration > 1:
-        inputFiles += ',' + lastContigsFile
+    if iteration > 1 and contigsFile != '':
+        inputFiles += ',' + contigsFile
+
+    # In delta mode, the index only contains sequence which has not been
+    # indexed in an earlier iteration (with flanks).  Any read that maps to
+    # older sequence was recruited in that earlier iteration and is carried
+    # forward, so the earlier indices don't need to be mapped to again and the
+    # recruited set is the same as it would be with the full index.
+    if args['delta_index']:
+        inputFiles = writeNewSequencesForIndex(iteration, iterDir, indexDir, contigsFile)
+        if inputFiles == '':
+            mappingIndex = None
+            mappingReference = []
+            print 'no new sequence'
+            return compactionMetrics
+
+    # The first iteration's index only holds the target, so it can come from
+    # the index cache.
     outputFiles = indexDir + '/bowtie2index'
-    bowtie2_buildCommand = ['bowtie2-build', inputFiles, outputFiles]
+    if iteration == 1 and args['index_cache'] is not None:
+        cached = linkCachedIndex(inputFiles, outputFiles, args['threads'])
+    else:
+        runIndexCommand(inputFiles, outputFiles, args['threads'])
+        cached = False
 
-    bowtie2_build = subprocess.Popen(bowtie2_buildCommand, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    out, err = bowtie2_build.communicate()
+    mappingIndex = outputFiles
+    mappingReference = inputFiles.split(',')
+    print 'reused (index cache)' if cached else 'done'
+    return compactionMetrics
 
-    # DO SOMETHING WITH out AND err HERE?
 
-    if bowtie2_build.returncode != 0:
-        print 'Bowtie 2 index construction failed.'
-        exit()
 
-    print 'done'
+def runIndexCommand(inputFiles, index, threads):
+    global commands
 
+    bowtie2_buildCommand = commands['index'][:]
+    bowtie2_buildCommand = replacePartOfCommand(bowtie2_buildCommand, 'REFERENCE_FILES', inputFiles)
+    bowtie2_buildCommand = replacePartOfCommand(bowtie2_buildCommand, 'INDEX', index)
+    bowtie2_buildCommand = replacePartOfCommand(bowtie2_buildCommand, 'THREADS', str(threads))
 
+    bowtie2_build = startLoggedProcess(bowtie2_buildCommand)
+    waitForProcesses([bowtie2_build], 'Bowtie 2 index construction failed.')
 
-# Use BWA or Bowtie to find reads that either map to the references
-# or have a pair that makes to the references.
-def mapPairedReads(iteration, iterDir):
+
+
+# Target indices are kept in a cache shared between runs (and users, if the
+# directory is shared), in a directory named by a hash of the indexed
+# sequences and the index command, so the same target with the same command
+# always finds the same entry.  Each entry has a lock file, held while it is
+# built or linked, so parallel runs wait for one build instead of each making
+# their own.  An entry is built in a temporary directory and renamed into
+# place, so a run which is killed never leaves a partial entry, and a failed
+# build removes its directory and lock file.  The entry's
+# files are hard-linked into the index directory (or symlinked, if the cache
+# is on another file system).  Returns whether the index was already cached.
+def linkCachedIndex(inputFiles, index, threads):
     global args
     global commands
 
-    print '   ' + getDateTimeString() + '  Mapping paired reads...',
-    sys.stdout.flush()
+    cacheDir = os.path.abspath(os.path.expanduser(args['index_cache']))
+    if not os.path.exists(cacheDir):
+        try:
+            os.makedirs(cacheDir)
+        except OSError as e:
+            if e.errno != errno.EEXIST:
+                raise
+
+    keyHash = hashlib.sha1(' '.join(commands['index']))
+    for fileName in inputFiles.split(','):
+        for name, sequence in loadFasta(fileName):
+            keyHash.update('>' + name + '\n' + sequence.upper() + '\n')
+    entryDir = cacheDir + '/' + keyHash.hexdigest()
+    indexName = os.path.basename(index)
+
+    lockFile = lockCacheEntry(entryDir, True)
+    try:
+        cached = os.path.isdir(entryDir)
+        if not cached:
+            buildDir = entryDir + '.' + str(os.getpid()) + '.tmp'
+            if os.path.exists(buildDir):
+                shutil.rmtree(buildDir)
+            os.makedirs(buildDir)
+            try:
+                runIndexCommand(inputFiles, buildDir + '/' + indexName, threads)
+                os.rename(buildDir, entryDir)
+            finally:
+                if os.path.exists(buildDir):
+                    shutil.rmtree(buildDir)
+
+        # The entry's modification time records its last use, for eviction.
+        os.utime(entryDir, None)
+        for fileName in os.listdir(entryDir):
+            if fileName.startswith(indexName + '.'):
+                linkFile(entryDir + '/' + fileName, os.path.dirname(index) + '/' + fileName)
+    finally:
+        if not os.path.isdir(entryDir):
+            os.remove(entryDir + '.lock')
+        fcntl.flock(lockFile, fcntl.LOCK_UN)
+        lockFile.close()
+
+    evictCachedIndices(cacheDir, entryDir)
+    return cached
+
+
+# Opens and locks an entry's lock file, or returns None if it isn't blocking
+# and the lock is held.  A lock file is deleted along with its entry, so a run
+# which was waiting on a deleted lock file tries again with a new one.
+def lockCacheEntry(entryDir, blocking):
+    lockName = entryDir + '.lock'
+    while True:
+        lockFile = open(lockName, 'a')
+        try:
+            fcntl.flock(lockFile, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except IOError:
+            lockFile.close()
+            return None
+        try:
+            if os.path.samestat(os.fstat(lockFile.fileno()), os.stat(lockName)):
+                return lockFile
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        fcntl.flock(lockFile, fcntl.LOCK_UN)
+        lockFile.close()
+
+
+# An entry on another file system (or one which can't be hard-linked) is
+# copied.  A symlink would break if another run evicted the entry while this
+# run was still using the index.
+def linkFile(sourceFile, linkName):
+    try:
+        os.link(sourceFile, linkName)
+    except OSError as e:
+        if e.errno != errno.EXDEV and e.errno != errno.EPERM:
+            raise
+        shutil.copyfile(sourceFile, linkName)
+
+
+# The least recently used entries are deleted until the cache fits in its size
+# limit, along with their lock files.  The entry just used is never deleted,
+# nor is any entry whose lock is held (it is being linked by another run).  Runs using a deleted entry have
+# their own hard links or copies of its files, so they aren't affected.
+def evictCachedIndices(cacheDir, keepDir):
+    global args
 
-    # Make a folder for the files
-    pairedDir = iterDir + '/2-paired_read_alignments'
-    os.makedirs(pairedDir)
+    limitBytes = int(args['index_cache_size'] * 1000000000)
+    entries = []
+    for fileName in os.listdir(cacheDir):
+        entryDir = cacheDir + '/' + fileName
+        if os.path.isdir(entryDir) and not fileName.endswith('.tmp'):
+            entries.append((os.path.getmtime(entryDir), entryDir, getTotalFileSize([entryDir])))
+    totalSize = sum(entry[2] for entry in entries)
+
+    for modificationTime, entryDir, entrySize in sorted(entries):
+        if totalSize <= limitBytes:
+            break
+        if entryDir == keepDir:
+            continue
+        lockFile = lockCacheEntry(entryDir, False)
+        if lockFile is None:
+            continue
+        try:
+            if os.path.isdir(entryDir):
+                shutil.rmtree(entryDir)
+                totalSize -= entrySize
+            os.remove(entryDir + '.lock')
+        finally:
+            fcntl.flock(lockFile, fcntl.LOCK_UN)
+            lockFile.close()
+
+
+
+# Writes the sequences for a delta index to a FASTA file in the index
+# directory and returns its path (or an empty string if there are none).  A
+# contig which grew only adds the regions which weren't indexed before: the
+# stretches not covered by any k-mer of earlier indexed sequence, each
+# extended by a read length on both sides, so reads which overlap the older
+# sequence still map.  Every sequence indexed so far is stored in each
+# iteration directory, so a resumed run knows what the previous iteration
+# indexed.
+def writeNewSequencesForIndex(iteration, iterDir, indexDir, contigsFile):
+    global args
 
-    # Prepare file paths
-    index = iterDir + '/1_mapping_index/bowtie2index'
-    unfilteredBam = pairedDir + '/alignments.bam'
-    bothBam = pairedDir + '/both.bam'
-    justReadBam = pairedDir + '/just_read.bam'
-    justMateBam = pairedDir + '/just_mate.bam'
-    mergedBam = pairedDir + '/merged.bam'
-    filteredReads1 = iterDir + '/filtered_reads_R1.fastq'
-    filteredReads2 = iterDir + '/filtered_reads_R2.fastq'
+    indexedSequences = []
+    if iteration > 1:
+        previousIndexedFile = getIterationDirectoryFullPath(iteration - 1) + 'indexed_sequences.fasta'
+        if os.path.isfile(previousIndexedFile):
+            indexedSequences = loadFasta(previousIndexedFile)
+
+    sequences = []
+    if iteration == 1 or len(indexedSequences) == 0:
+        sequences += loadFasta(args['t'])
+    if iteration > 1 and contigsFile != '':
+        sequences += loadFasta(contigsFile)
+
+    kmerSize = 31
+    indexedKmers = set()
+    for name, sequence in indexedSequences:
+        indexedKmers.update(getCanonicalKmerHashes(sequence.upper(), kmerSize))
+    flankLength = getMaximumReadLength() if len(indexedKmers) > 0 else 0
+
+    newSequences = []
+    for name, sequence in sequences:
+        sequence = sequence.upper()
+        kmerHashes = getCanonicalKmerHashes(sequence, kmerSize)
+        for start, end in getNewRegions(len(sequence), kmerHashes, indexedKmers, kmerSize, flankLength):
+            if start == 0 and end == len(sequence):
+                newSequences.append((name, sequence))
+            else:
+                newSequences.append((name + '_' + str(start + 1) + '-' + str(end), sequence[start:end]))
+        indexedKmers.update(kmerHashes)
+
+    saveFasta(indexedSequences + newSequences, iterDir + '/indexed_sequences.fasta')
+
+    if len(newSequences) == 0:
+        return ''
+
+    newSequencesFile = indexDir + '/new_sequences.fasta'
+    saveFasta(newSequences, newSequencesFile)
+    return newSequencesFile
+
+
+# Returns the (start, end) of each region of a sequence which isn't covered by
+# an indexed k-mer, extended by the flank length and merged where they meet.
+def getNewRegions(sequenceLength, kmerHashes, indexedKmers, kmerSize, flankLength):
+    regions = []
+    coveredEnd = 0
+    regionStart = None
+    for i in range(sequenceLength):
+        if i < len(kmerHashes) and kmerHashes[i] in indexedKmers:
+            coveredEnd = max(coveredEnd, i + kmerSize)
+        if i >= coveredEnd and regionStart is None:
+            regionStart = i
+        elif i < coveredEnd and regionStart is not None:
+            regions.append((regionStart, i))
+            regionStart = None
+    if regionStart is not None:
+        regions.append((regionStart, sequenceLength))
+
+    flankedRegions = []
+    for start, end in regions:
+        start = max(0, start - flankLength)
+        end = min(sequenceLength, end + flankLength)
+        if len(flankedRegions) > 0 and start <= flankedRegions[-1][1]:
+            flankedRegions[-1] = (flankedRegions[-1][0], end)
+        else:
+            flankedRegions.append((start, end))
+    return flankedRegions
 
-    # Use Bowtie2 to run the alignment
-    bowtie2Command = commands['map_paired'][:]
-    bowtie2Command = replacePartOfCommand(bowtie2Command, 'INDEX', index)
-    bowtie2Command = replacePartOfCommand(bowtie2Command, 'PAIRED_READS_FILE_1', args['1'])
-    bowtie2Command = replacePartOfCommand(bowtie2Command, 'PAIRED_READS_FILE_2', args['2'])
 
-    # Use samtools sort to make a sorted bam of the alignments
-    samtools_sortCommand = ['samtools', 'sort', '-n', '-o', unfilteredBam, '-']
+# The longest of the first reads in the input files, which is taken as the
+# read length.
+def getMaximumReadLength():
+    global args
+
+    maximumLength = 0
+    for readFile in (args['1'], args['2'], args['u']):
+        if readFile != None:
+            for batch in readFastqBatches(readFile, 10000):
+                maximumLength = max([maximumLength] + [len(record[1].rstrip()) for record in batch])
+                break
+    return maximumLength
+
+
+
+# Assemblers like SPAdes output short contigs, reverse complement duplicates
+# and contigs which are contained in the target or in a longer contig.  None
+# of these add anything to the index, but they do make reads map to more than
+# one place.  Contigs are taken longest first, and a contig is dropped if it
+# is below the minimum length, or if it (or its reverse complement) is a
+# substring of the target or of a longer contig already kept.  Substrings are
+# only searched for in sequences which share all of the contig's minimisers:
+# every window of a substring is a window of the sequence containing it, so
+# the substring's minimisers are a subset of that sequence's.  Each dropped
+# contig is listed in the stage log.  Returns the compacted contigs file and
+# the counts for the stage metrics.
+def writeCompactedContigs(iterDir, indexDir, contigsFile):
+    global args
+
+    kmerSize = 15
+    windowSize = 10
+
+    keptSequences = [sequence.upper() for name, sequence in loadFasta(args['t'])]
+    minimiserIndex = collections.defaultdict(list)
+    for sequenceNumber, sequence in enumerate(keptSequences):
+        for minimiser in getMinimisers(sequence, kmerSize, windowSize):
+            minimiserIndex[minimiser].append(sequenceNumber)
+
+    contigs = loadFasta(contigsFile)
+    contigOrder = sorted(range(len(contigs)), key=lambda i: -len(contigs[i][1]))
+    keptContigs = set()
+    removedCounts = {'short': 0, 'duplicate': 0, 'contained': 0}
+    removedLength = 0
+    logFile = open(getStageLogFile(), 'a')
+    for contigNumber in contigOrder:
+        name, sequence = contigs[contigNumber]
+        sequence = sequence.upper()
+        reason = None
+        if len(sequence) < args['min_contig_length']:
+            reason = 'short'
+        else:
+            reverseComplement = getReverseComplement(sequence)
+            for sequenceNumber in getMinimiserCandidates(sequence, minimiserIndex, len(keptSequences), kmerSize, windowSize):
+                keptSequence = keptSequences[sequenceNumber]
+                if sequence in keptSequence or reverseComplement in keptSequence:
+                    reason = 'duplicate' if len(keptSequence) == len(sequence) else 'contained'
+                    break
+        if reason is not None:
+            removedCounts[reason] += 1
+            removedLength += len(sequence)
+            logFile.write('Removed ' + reason + ' contig: ' + name + ' (' + str(len(sequence)) + ' bp)\n')
+            continue
+        keptContigs.add(contigNumber)
+        for minimiser in getMinimisers(sequence, kmerSize, windowSize):
+            minimiserIndex[minimiser].append(len(keptSequences))
+        keptSequences.append(sequence)
+
+    removedCount = len(contigs) - len(keptContigs)
+    summary = 'removed ' + str(removedCount) + ' of ' + str(len(contigs)) + ' contigs (' + str(removedLength) + ' bp)'
+    logFile.write('Compaction ' + summary + ': ' + str(removedCounts['short']) + ' short, ' + str(removedCounts['duplicate']) + ' duplicate, ' + str(removedCounts['contained']) + ' contained\n')
+    logFile.close()
+    print summary + '...',
+    sys.stdout.flush()
+
+    compactedFile = indexDir + '/compacted_contigs.fasta'
+    saveFasta([contigs[i] for i in range(len(contigs)) if i in keptContigs], compactedFile)
+    compactionMetrics = {'removed_short_contigs': removedCounts['short'],
+                         'removed_duplicate_contigs': removedCounts['duplicate'],
+                         'removed_contained_contigs': removedCounts['contained'],
+                         'removed_contig_length': removedLength}
+    return compactedFile, compactionMetrics
+
+
+# A minimiser is the smallest canonical k-mer hash in a window of
+# consecutive k-mers.  A sequence shorter than one window has none.
+def getMinimisers(sequence, kmerSize, windowSize):
+    kmers = getCanonicalKmerHashes(sequence, kmerSize)
+    return set(min(kmers[i:i+windowSize]) for i in range(len(kmers) - windowSize + 1))
+
+
+# Returns the numbers of the indexed sequences which have all of a
+# sequence's minimisers.  A sequence with no minimisers could be in any of
+# them.
+def getMinimiserCandidates(sequence, minimiserIndex, sequenceCount, kmerSize, windowSize):
+    candidates = None
+    for minimiser in getMinimisers(sequence, kmerSize, windowSize):
+        sequenceNumbers = set(minimiserIndex.get(minimiser, []))
+        candidates = sequenceNumbers if candidates is None else candidates & sequenceNumbers
+        if len(candidates) == 0:
+            return []
+    if candidates is None:
+        return range(sequenceCount)
+    return sorted(candidates)
+
+
+
+# Contigs only grow at their ends, so in frontier mode the index gets a window
+# at each end of each contig instead of the whole contig (a contig no longer
+# than two windows is used whole).  An end whose window is the same as one
+# indexed in an earlier iteration has stopped growing: the reads that map to
+# it were recruited then and are carried forward, so it is dropped.  The
+# hashes of every window indexed so far are stored in each iteration
+# directory.  Returns the FASTA file of ends to index (or an empty string if
+# there are none).
+def writeFrontierSequences(iteration, iterDir, indexDir, contigsFile):
+    global args
+
+    seenHashes = set()
+    previousHashFile = getIterationDirectoryFullPath(iteration - 1) + 'frontier_ends.txt'
+    if os.path.isfile(previousHashFile):
+        seenHashes = set(line.strip() for line in open(previousHashFile))
+
+    window = args['frontier']
+    contigEnds = []
+    for name, sequence in loadFasta(contigsFile):
+        if len(sequence) <= 2 * window:
+            contigEnds.append((name, sequence))
+        else:
+            contigEnds.append((name + '_start', sequence[:window]))
+            contigEnds.append((name + '_end', sequence[-window:]))
+
+    growingEnds = []
+    for name, sequence in contigEnds:
+        sequenceHash = getSequenceHash(sequence)
+        if sequenceHash not in seenHashes:
+            seenHashes.add(sequenceHash)
+            growingEnds.append((name, sequence))
+
+    hashFile = open(iterDir + '/frontier_ends.txt', 'w')
+    for sequenceHash in sorted(seenHashes):
+        hashFile.write(sequenceHash + '\n')
+    hashFile.close()
+
+    print str(len(growingEnds)) + ' of ' + str(len(contigEnds)) + ' contig ends growing...',
+    sys.stdout.flush()
+
+    if len(growingEnds) == 0:
+        return ''
+
+    frontierFile = indexDir + '/frontier.fasta'
+    saveFasta(growingEnds, frontierFile)
+    return frontierFile
+
+
+
+# At the start of each iteration, the reads given to the mapper are the input
+# read files.  Later stages, like the prefilter, can swap in smaller files.
+# In per-target runs, the first iteration starts from the candidate reads
+# which were prefiltered for all targets in one shared pass.
+def setMappingReadFiles(iteration):
+    global args
+    global mappingReadFiles
+    global sharedCandidateFiles
+
+    mappingReadFiles = {'1': args['1'], '2': args['2'], 'u': args['u']}
+    if iteration == 1 and len(sharedCandidateFiles) > 0:
+        mappingReadFiles.update(sharedCandidateFiles)
+
+
+
+# Reads recruited in an earlier iteration are carried forward whatever the
+# mapping finds, so mapping them again is wasted work.  The mapper is only
+# given the reads (and pairs) which weren't in the previous iteration's
+# filtered reads.  Each read maps the same way whatever else is mapped with
+# it, so after carry-forward the recruited reads are the same as when every
+# read is mapped.  The unrecruited reads are kept in the iteration directory
+# until the next iteration has made its own from them, so the pool of reads
+# to map shrinks as the run goes on.
+def skipRecruitedReads(iteration, poolDir, sourceFiles):
+    global mappingReadFiles
+
+    print '   ' + getDateTimeString() + '  Skipping recruited reads...',
+    sys.stdout.flush()
+
+    previousIterDir = getIterationDirectoryFullPath(iteration - 1)
+    readCount = 0
+    keptCount = 0
+
+    if sourceFiles['1'] != None and sourceFiles['2'] != None:
+        recruitedPairs = makeReadNameHashArray(getFilteredReadsFile(previousIterDir, 'R1'))
+        unrecruited1 = getUnrecruitedReadsFile(poolDir, 'R1')
+        unrecruited2 = getUnrecruitedReadsFile(poolDir, 'R2')
+        output1 = openReadsForWriting(unrecruited1)
+        output2 = openReadsForWriting(unrecruited2)
+        for batch1, batch2 in itertools.izip(readFastqBatches(sourceFiles['1']), readFastqBatches(sourceFiles['2'])):
+            kept1 = []
+            kept2 = []
+            for record1, record2 in zip(batch1, batch2):
+                if not isHashInSortedArray(getReadNameHash(record1[0]), recruitedPairs):
+                    kept1.append(''.join(record1))
+                    kept2.append(''.join(record2))
+            output1.write(''.join(kept1))
+            output2.write(''.join(kept2))
+            readCount += 2 * len(batch1)
+            keptCount += 2 * len(kept1)
+        output1.close()
+        output2.close()
+        mappingReadFiles['1'] = unrecruited1
+        mappingReadFiles['2'] = unrecruited2
+
+    if sourceFiles['u'] != None:
+        recruitedReads = makeReadNameHashArray(getFilteredReadsFile(previousIterDir, 'U'), False)
+        unrecruitedU = getUnrecruitedReadsFile(poolDir, 'U')
+        outputU = openReadsForWriting(unrecruitedU)
+        for batch in readFastqBatches(sourceFiles['u']):
+            kept = [''.join(record) for record in batch
+                    if not isHashInSortedArray(getReadNameHash(record[0], False), recruitedReads)]
+            outputU.write(''.join(kept))
+            readCount += len(batch)
+            keptCount += len(kept)
+        outputU.close()
+        mappingReadFiles['u'] = unrecruitedU
+
+    print 'done (' + str(keptCount) + ' of ' + str(readCount) + ' reads left to map)'
+
+
+# The previous iteration's unrecruited reads are a smaller place to start
+# than the input files, if they are still there.
+def getUnrecruitedReadsSources(iteration):
+    global mappingReadFiles
+
+    previousPoolDir = getWorkingDirectory(getIterationDirectoryFullPath(iteration - 1))
+    sourceFiles = dict(mappingReadFiles)
+    for readType, fileType in (('1', 'R1'), ('2', 'R2'), ('u', 'U')):
+        previousUnrecruitedFile = getUnrecruitedReadsFile(previousPoolDir, fileType)
+        if sourceFiles[readType] != None and os.path.isfile(previousUnrecruitedFile):
+            sourceFiles[readType] = previousUnrecruitedFile
+    if (sourceFiles['1'] == mappingReadFiles['1']) != (sourceFiles['2'] == mappingReadFiles['2']):
+        sourceFiles['1'] = mappingReadFiles['1']
+        sourceFiles['2'] = mappingReadFiles['2']
+    return sourceFiles
+
+
+def getUnrecruitedReadsFile(poolDir, readType):
+    return getFilteredReadsFile(poolDir, readType).replace('/filtered_reads_', '/unrecruited_reads_')
+
+
+def deleteUnrecruitedReads(poolDir):
+    for readType in ('R1', 'R2', 'U'):
+        unrecruitedFile = getUnrecruitedReadsFile(poolDir, readType)
+        if os.path.isfile(unrecruitedFile):
+            os.remove(unrecruitedFile)
+
+
+
+# Reads are only worth mapping if they share at least one exact k-mer with
+# the mapping reference.  Bowtie 2 needs an exact seed match to align a read,
+# so as long as K is no larger than the seed length, no read the mapper could
+# align is dropped here.  Read k-mers are checked with a step that still
+# catches every exact seed-length match.
+def prefilterReads(iterDir):
+    global args
+    global mappingIndex
+    global mappingReference
+    global mappingReadFiles
+
+    print '   ' + getDateTimeString() + '  Prefiltering reads...',
+    sys.stdout.flush()
+
+    # Make a folder for the files
+    prefilterDir = getWorkingDirectory(iterDir) + '/0_prefilter'
+    os.makedirs(prefilterDir)
+
+    # If there is nothing to map to, then the mapping will be skipped anyway.
+    if mappingIndex is None:
+        print 'skipped'
+        return
+
+    kmerSize = args['prefilter']
+    step = args['seed_length'] - kmerSize + 1
+    kmers = makeKmerSet(mappingReference, kmerSize)
+
+    readCount = 0
+    keptCount = 0
+
+    if mappingReadFiles['1'] != None and mappingReadFiles['2'] != None:
+        candidates1 = prefilterDir + '/candidates_R1.fastq'
+        candidates2 = prefilterDir + '/candidates_R2.fastq'
+        output1 = open(candidates1, 'w')
+        output2 = open(candidates2, 'w')
+        for batch1, batch2 in zip(readFastqBatches(mappingReadFiles['1']), readFastqBatches(mappingReadFiles['2'])):
+            kept1 = []
+            kept2 = []
+            for record1, record2 in zip(batch1, batch2):
+                if readSharesKmer(record1[1], kmers, kmerSize, step) or readSharesKmer(record2[1], kmers, kmerSize, step):
+                    kept1.append(''.join(record1))
+                    kept2.append(''.join(record2))
+            output1.write(''.join(kept1))
+            output2.write(''.join(kept2))
+            readCount += 2 * len(batch1)
+            keptCount += 2 * len(kept1)
+        output1.close()
+        output2.close()
+        mappingReadFiles['1'] = candidates1
+        mappingReadFiles['2'] = candidates2
+
+    if mappingReadFiles['u'] != None:
+        candidatesU = prefilterDir + '/candidates_U.fastq'
+        outputU = open(candidatesU, 'w')
+        for batch in readFastqBatches(mappingReadFiles['u']):
+            kept = [''.join(record) for record in batch if readSharesKmer(record[1], kmers, kmerSize, step)]
+            outputU.write(''.join(kept))
+            readCount += len(batch)
+            keptCount += len(kept)
+        outputU.close()
+        mappingReadFiles['u'] = candidatesU
+
+    print 'done (' + str(keptCount) + ' of ' + str(readCount) + ' reads kept)'
+
+
+
+# Makes a set of every k-mer in the given FASTA files, on both strands.
+def makeKmerSet(fastaFiles, kmerSize):
+    kmers = set()
+    for fastaFile in fastaFiles:
+        for name, sequence in loadFasta(fastaFile):
+            for strand in (sequence, getReverseComplement(sequence)):
+                for i in range(len(strand) - kmerSize + 1):
+                    kmers.add(strand[i:i+kmerSize])
+    return kmers
+
+
+
+# The sequence line still has its newline, so the last k-mer ends one
+# character before the end of the line.
+def readSharesKmer(sequenceLine, kmers, kmerSize, step):
+    lastStart = len(sequenceLine.rstrip()) - kmerSize
+    if lastStart < 0:
+        return False
+    for i in range(0, lastStart + 1, step):
+        if sequenceLine[i:i+kmerSize].upper() in kmers:
+            return True
+
+    # Make sure the read's final k-mer is checked even when the step does not
+    # land on it.
+    return sequenceLine[lastStart:lastStart+kmerSize].upper() in kmers
+
+
+
+# Maps the paired and unpaired reads.  When there are both, the two mapping
+# stages run at the same time, with the threads split between them in
+# proportion to how much read data each has to map.
+def mapReads(iteration, iterDir):
+    global args
+    global mappingReadFiles
+
+    if isMappingChunked():
+        mapReadsInChunks(iteration, iterDir)
+        return
+
+    stages = []
+    if args['1'] != None and args['2'] != None:
+        stages.append((mapPairedReads, 'map_paired', [mappingReadFiles['1'], mappingReadFiles['2']],
+                       [getFilteredReadsFile(iterDir, 'R1'), getFilteredReadsFile(iterDir, 'R2')]))
+    if args['u'] != None:
+        stages.append((mapUnpairedReads, 'map_unpaired', [mappingReadFiles['u']],
+                       [getFilteredReadsFile(iterDir, 'U')]))
+
+    if len(stages) == 1 or args['threads'] < len(stages):
+        for mappingFunction, stageName, readFiles, filteredReadsFiles in stages:
+            runMeasuredStage(iteration, stageName, readFiles, filteredReadsFiles, mappingFunction, (iteration, iterDir, args['threads']))
+        return
+
+    threadCounts = allocateThreads(args['threads'], [getTotalFileSize(stage[2]) for stage in stages])
+
+    print '   ' + getDateTimeString() + '  Mapping paired and unpaired reads (' + ' + '.join(str(threads) for threads in threadCounts) + ' threads)...',
+    sys.stdout.flush()
+
+    runConcurrently([(runMeasuredStage, (iteration, stageName, readFiles, filteredReadsFiles, mappingFunction, (iteration, iterDir, threads, False)))
+                     for (mappingFunction, stageName, readFiles, filteredReadsFiles), threads in zip(stages, threadCounts)])
+
+    print 'done'
+
+
+
+# Reads are mapped in chunks when chunks were made and the mapper is given
+# the input reads.  In a per-target run, the first iteration maps the shared
+# prefiltered candidates instead, which aren't chunked.
+def isMappingChunked():
+    global args
+    global mappingIndex
+    global mappingReadFiles
+    global readChunks
+
+    inputReadFiles = {'1': args['1'], '2': args['2'], 'u': args['u']}
+    return len(readChunks) > 0 and mappingIndex is not None and mappingReadFiles == inputReadFiles
+
+
+# Scatter/gather mapping: each chunk is prefiltered (if asked), mapped and
+# filtered by its own task, in its own directory.  The tasks run through an
+# executor, and their filtered reads are gathered in chunk order, so they
+# come out in the same order as the input reads.
+def mapReadsInChunks(iteration, iterDir):
+    global args
+    global readChunks
+
+    tasks = []
+    for chunkType in ('paired', 'unpaired'):
+        for chunkNumber, chunkFiles in enumerate(readChunks.get(chunkType, [])):
+            tasks.append([iteration, iterDir, chunkType, chunkNumber + 1, chunkFiles])
+    workers = min(len(tasks), args['threads'])
+    threadsPerTask = max(1, args['threads'] // workers)
+    for task in tasks:
+        task.append(threadsPerTask)
+
+    print '   ' + getDateTimeString() + '  Mapping reads in ' + str(len(tasks)) + ' chunks (' + str(workers) + ' at a time with ' + str(threadsPerTask) + ' thread' + ('s' if threadsPerTask > 1 else '') + ' each)...',
+    sys.stdout.flush()
+
+    os.makedirs(getWorkingDirectory(iterDir) + '/2-read_chunks')
+    results = getExecutor(workers).run(mapReadChunk, [tuple(task) for task in tasks], isChunkFailure)
+
+    failedChunks = [result[0] for result in results if isChunkFailure(result)]
+    if len(failedChunks) > 0:
+        print '\n\nERROR: mapping failed for chunk ' + os.path.basename(failedChunks[0]) + ' (see ' + failedChunks[0] + '/chunk.log)'
+        exit()
+    if None in results:
+        print '\n\nERROR: mapping stopped before every chunk was done.'
+        exit()
+
+    gatheredFiles = {}
+    for chunkDir, filteredReadsFiles in results:
+        for filteredReadsFile in filteredReadsFiles:
+            gatheredFiles.setdefault(os.path.basename(filteredReadsFile), []).append(filteredReadsFile)
+    for fileName, chunkFiles in gatheredFiles.items():
+        concatenateFiles(chunkFiles, iterDir + '/' + fileName)
+
+    print 'done'
+
+
+def isChunkFailure(result):
+    return result is not None and result[1] is None
+
+
+# Runs as a task.  It points the mapping read files at its chunk, so in a
+# worker process (with its own copy of the global state) or when run in
+# Irsat's own process, the mapping functions map just the chunk.  Output
+# goes to a log in the chunk's directory.  Returns the chunk's directory and
+# its filtered read files, or None for the files if the chunk failed.
+def mapReadChunk(task):
+    global args
+    global mappingReadFiles
+
+    iteration, iterDir, chunkType, chunkNumber, chunkFiles, threads = task
+    chunkDir = getWorkingDirectory(iterDir) + '/2-read_chunks/' + chunkType + '_' + '%03d' % chunkNumber
+    os.makedirs(chunkDir)
+
+    savedMappingReadFiles = mappingReadFiles
+    if chunkType == 'paired':
+        mappingReadFiles = {'1': chunkFiles[0], '2': chunkFiles[1], 'u': None}
+        mappingFunction = mapPairedReads
+        filteredReadsFiles = [getFilteredReadsFile(chunkDir, 'R1'), getFilteredReadsFile(chunkDir, 'R2')]
+    else:
+        mappingReadFiles = {'1': None, '2': None, 'u': chunkFiles[0]}
+        mappingFunction = mapUnpairedReads
+        filteredReadsFiles = [getFilteredReadsFile(chunkDir, 'U')]
+
+    savedStdout = sys.stdout
+    sys.stdout = open(chunkDir + '/chunk.log', 'a', 1)
+    currentStage.logFile = chunkDir + '/chunk.log'
+    try:
+        if args['skip_recruited'] and iteration > 1:
+            skipRecruitedReads(iteration, chunkDir, dict(mappingReadFiles))
+        if args['prefilter'] > 0:
+            prefilterReads(chunkDir)
+        startStageMetrics(iteration, 'map_' + chunkType, mappingReadFiles.values())
+        mappingFunction(iteration, chunkDir, threads)
+        finishStageMetrics(currentStage.metrics, filteredReadsFiles, {'chunk': chunkNumber})
+        return chunkDir, filteredReadsFiles
+    except SystemExit:
+        return chunkDir, None
+    finally:
+        abandonStageMetrics()
+        sys.stdout.close()
+        sys.stdout = savedStdout
+        currentStage.logFile = None
+        mappingReadFiles = savedMappingReadFiles
+
+
+def makeReadChunks():
+    global args
+    global readChunks
+
+    print '\nSplitting read files into chunks:'
+
+    if args['1'] != None and args['2'] != None:
+        readChunks['paired'] = loadOrMakeReadChunks('paired', [args['1'], args['2']])
+    if args['u'] != None:
+        readChunks['unpaired'] = loadOrMakeReadChunks('unpaired', [args['u']])
+
+
+# Chunks are runs of consecutive reads (the same runs for both files of a
+# pair).  They are made once, in OUTDIR/read_chunks, and used by every
+# iteration, and by later runs with the same read files and chunk count.
+# Returns a list of the files for each chunk.
+def loadOrMakeReadChunks(chunksName, readFiles):
+    global args
+    global outDir
+
+    print '   ' + getDateTimeString() + '  Splitting ' + chunksName + ' reads...',
+    sys.stdout.flush()
+
+    chunksDir = outDir + '/read_chunks'
+    if not os.path.exists(chunksDir):
+        os.makedirs(chunksDir)
+
+    sourceFile = chunksDir + '/' + chunksName + '.source'
+    source = 'chunks\t' + str(args['chunks']) + '\t' + str(args['compress']) + '\n'
+    for readFile in readFiles:
+        source += os.path.abspath(readFile) + '\t' + str(os.path.getsize(readFile)) + '\t' + str(os.path.getmtime(readFile)) + '\n'
+
+    suffix = '.fastq.gz' if args['compress'] else '.fastq'
+    def getChunkFiles(chunkCount):
+        return [[chunksDir + '/' + chunksName + '_' + '%03d' % (chunkNumber + 1) + '_' + str(fileNumber + 1) + suffix
+                 for fileNumber in range(len(readFiles))] for chunkNumber in range(chunkCount)]
+
+    if os.path.isfile(sourceFile) and open(sourceFile, 'r').read().startswith(source):
+        chunkCount = int(open(sourceFile, 'r').read().splitlines()[-1])
+        readCount = None
+        print 'loaded',
+    else:
+        readCount = countFastqRecords(readFiles[0])
+        chunkSize = max(1, -(-readCount // args['chunks']))
+        chunkCount = max(1, -(-readCount // chunkSize))
+        chunkFiles = getChunkFiles(chunkCount)
+
+        for fileNumber, readFile in enumerate(readFiles):
+            fileReadCount = 0
+            outputs = [openReadsForWriting(files[fileNumber]) for files in chunkFiles]
+            for batch in readFastqBatches(readFile):
+                for record in batch:
+                    outputs[fileReadCount // chunkSize].write(''.join(record))
+                    fileReadCount += 1
+            for output in outputs:
+                output.close()
+            if fileReadCount != readCount:
+                print '\n\nERROR: the paired read files do not contain the same number of reads.'
+                exit()
+
+        # The source is written last, so interrupted chunking is redone.
+        sourceOutput = open(sourceFile, 'w')
+        sourceOutput.write(source + str(chunkCount) + '\n')
+        sourceOutput.close()
+        print 'done',
+
+    print '(' + str(chunkCount) + ' chunks' + ('' if readCount is None else ' of up to ' + str(-(-readCount // chunkCount)) + ' reads') + ')'
+    return getChunkFiles(chunkCount)
+
+
+
+# Use BWA or Bowtie to find reads that either map to the references
+# or have a pair that makes to the references.
+def mapPairedReads(iteration, iterDir, threads, report=True):
+    global args
+    global commands
+    global mappingIndex
+    global mappingReadFiles
+
+    if report:
+        print '   ' + getDateTimeString() + '  Mapping paired reads...',
+        sys.stdout.flush()
+
+    # Make a folder for the files
+    pairedDir = getWorkingDirectory(iterDir) + '/2-paired_read_alignments'
+    os.makedirs(pairedDir)
+
+    # Prepare file paths
+    index = mappingIndex
+    unfilteredBam = pairedDir + '/alignments.bam'
+    bothBam = pairedDir + '/both.bam'
+    justReadBam = pairedDir + '/just_read.bam'
+    justMateBam = pairedDir + '/just_mate.bam'
+    mergedBam = pairedDir + '/merged.bam'
+    filteredReads1 = getFilteredReadsFile(iterDir, 'R1')
+    filteredReads2 = getFilteredReadsFile(iterDir, 'R2')
+
+    # If there was nothing new to index, no reads can be newly recruited.
+    if index is None:
+        openReadsForWriting(filteredReads1).close()
+        openReadsForWriting(filteredReads2).close()
+        if report:
+            print 'skipped'
+        return
+
+    # Use Bowtie2 to run the alignment
+    bowtie2Command = getIterationCommand('map_paired', iteration)[:]
+    bowtie2Command = replacePartOfCommand(bowtie2Command, 'INDEX', index)
+    bowtie2Command = replacePartOfCommand(bowtie2Command, 'THREADS', str(threads))
+    bowtie2Command = replacePartOfCommand(bowtie2Command, 'PAIRED_READS_FILE_1', mappingReadFiles['1'])
+    bowtie2Command = replacePartOfCommand(bowtie2Command, 'PAIRED_READS_FILE_2', mappingReadFiles['2'])
+
+    if args['stream_filter']:
+        streamFilterAlignments(bowtie2Command, filteredReads1, filteredReads2, None)
+        if report:
+            print 'done'
+        return
+
+    # Use samtools sort to make a sorted bam of the alignments
+    samtools_sortCommand = ['samtools', 'sort', '-n', '-o', unfilteredBam, '-']
 
     # Run the commands!
-    bowtie2 = subprocess.Popen(bowtie2Command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    samtools_sort = subprocess.Popen(samtools_sortCommand, stdin=bowtie2.stdout, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    samtools_sort.communicate()
+    bowtie2 = startLoggedProcess(bowtie2Command, stdout=subprocess.PIPE)
+    samtools_sort = startLoggedProcess(samtools_sortCommand, stdin=bowtie2.stdout)
+    bowtie2.stdout.close()
+    waitForProcesses([bowtie2, samtools_sort], 'Read mapping failed')
+    splitStageMetrics('filter_paired', [unfilteredBam])
 
-    # Use samtools view to produce three separate files:
+    # Use samtools view to produce three separate files, all at once:
     #  -reads containing neither 4 nor 8 (read and mate mapped)
     #  -reads containing 8 but not 4 (read mapped, mate didn't)
     #  -reads containing 4 but not 8 (mate mapped, read didn't)
     samtools_viewCommandBoth = ['samtools', 'view', '-u', '-F', '12', '-o', bothBam, unfilteredBam]
-    samtools_viewBoth = subprocess.Popen(samtools_viewCommandBoth, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    samtools_viewBoth.communicate()
+    samtools_viewBoth = startLoggedProcess(samtools_viewCommandBoth)
 
     samtools_viewCommandJustRead = ['samtools', 'view', '-u', '-f', '8', '-F', '4', '-o', justReadBam, unfilteredBam]
-    samtools_viewJustRead = subprocess.Popen(samtools_viewCommandJustRead, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    samtools_viewJustRead.communicate()
+    samtools_viewJustRead = startLoggedProcess(samtools_viewCommandJustRead)
 
     samtools_viewCommandJustMate = ['samtools', 'view', '-u', '-f', '4', '-F', '8', '-o', justMateBam, unfilteredBam]
-    samtools_viewJustMate = subprocess.Popen(samtools_viewCommandJustMate, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    samtools_viewJustMate.communicate()
+    samtools_viewJustMate = startLoggedProcess(samtools_viewCommandJustMate)
 
-    if samtools_viewBoth.returncode != 0 or samtools_viewJustRead.returncode != 0 or samtools_viewJustMate.returncode != 0:
-        print 'Samtools view filtering failed'
-        exit()
+    waitForProcesses([samtools_viewBoth, samtools_viewJustRead, samtools_viewJustMate], 'Samtools view filtering failed')
+    deleteIntermediateFiles([unfilteredBam])
 
     # Merge the BAMs into one file
     samtools_mergeCommand = ['samtools', 'merge', '-n', mergedBam, bothBam, justReadBam, justMateBam]
-    samtools_merge = subprocess.Popen(samtools_mergeCommand, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    samtools_merge.communicate()
+    samtools_merge = startLoggedProcess(samtools_mergeCommand)
+    waitForProcesses([samtools_merge], 'Samtools merge failed')
+    deleteIntermediateFiles([bothBam, justReadBam, justMateBam])
 
     # Use bedtools bamtofastq to convert the BAM file to two fastq files
-    bamtofastqCommand = ['bedtools', 'bamtofastq', '-i', mergedBam, '-fq', filteredReads1, '-fq2', filteredReads2]
-    bamtofastq = subprocess.Popen(bamtofastqCommand, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    bamtofastq.communicate()
+    # Bedtools can only write plain FASTQ, so compressed output goes through a
+    # temporary file.
+    bamtofastqReads1 = pairedDir + '/filtered_reads_R1.fastq' if args['compress'] else filteredReads1
+    bamtofastqReads2 = pairedDir + '/filtered_reads_R2.fastq' if args['compress'] else filteredReads2
+    bamtofastqCommand = ['bedtools', 'bamtofastq', '-i', mergedBam, '-fq', bamtofastqReads1, '-fq2', bamtofastqReads2]
+    bamtofastq = startLoggedProcess(bamtofastqCommand)
+    waitForProcesses([bamtofastq], 'BAM to FASTQ conversion failed')
+    deleteIntermediateFiles([mergedBam])
 
-    if bamtofastq.returncode != 0:
-        print 'BAM to FASTQ conversion failed'
-        exit()
+    if args['compress']:
+        compressFile(bamtofastqReads1, filteredReads1)
+        compressFile(bamtofastqReads2, filteredReads2)
+        deleteIntermediateFiles([bamtofastqReads1, bamtofastqReads2])
 
-    print 'done'
+    if report:
+        print 'done'
 
 
 
 # Use BWA or Bowtie to find reads that either map to the references
 # or have a pair that makes to the references.
-def mapUnpairedReads(iteration, iterDir):
+def mapUnpairedReads(iteration, iterDir, threads, report=True):
     global args
-    print '   ' + getDateTimeString() + '  Mapping unpaired reads...',
-    sys.stdout.flush()
+    global mappingIndex
+    global mappingReadFiles
+
+    if report:
+        print '   ' + getDateTimeString() + '  Mapping unpaired reads...',
+        sys.stdout.flush()
 
     # Make a folder for the files
-    unpairedDir = iterDir + '/2-unpaired_read_alignments'
+    unpairedDir = getWorkingDirectory(iterDir) + '/2-unpaired_read_alignments'
     os.makedirs(unpairedDir)
 
     # Prepare file paths
-    index = iterDir + '/1_mapping_index/bowtie2index'
+    index = mappingIndex
     unfilteredBam = unpairedDir + '/alignments.bam'
     filteredBam = unpairedDir + '/filtered.bam'
-    filteredReads = iterDir + '/filtered_reads_U.fastq'
+    filteredReads = getFilteredReadsFile(iterDir, 'U')
+
+    # If there was nothing new to index, no reads can be newly recruited.
+    if index is None:
+        openReadsForWriting(filteredReads).close()
+        if report:
+            print 'skipped'
+        return
 
     # Use Bowtie2 to run the alignment
-    bowtie2Command = commands['map_unpaired'][:]
+    bowtie2Command = getIterationCommand('map_unpaired', iteration)[:]
     bowtie2Command = replacePartOfCommand(bowtie2Command, 'INDEX', index)
-    bowtie2Command = replacePartOfCommand(bowtie2Command, 'UNPAIRED_READS_FILE', args['u'])
+    bowtie2Command = replacePartOfCommand(bowtie2Command, 'THREADS', str(threads))
+    bowtie2Command = replacePartOfCommand(bowtie2Command, 'UNPAIRED_READS_FILE', mappingReadFiles['u'])
+
+    if args['stream_filter']:
+        streamFilterAlignments(bowtie2Command, None, None, filteredReads)
+        if report:
+            print 'done'
+        return
 
     # Use samtools sort to make a sorted bam of the alignments
     samtools_sortCommand = ['samtools', 'sort', '-n', '-o', unfilteredBam, '-']
 
     # Run the commands!
-    bowtie2 = subprocess.Popen(bowtie2Command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    samtools_sort = subprocess.Popen(samtools_sortCommand, stdin=bowtie2.stdout, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    samtools_sort.communicate()
+    bowtie2 = startLoggedProcess(bowtie2Command, stdout=subprocess.PIPE)
+    samtools_sort = startLoggedProcess(samtools_sortCommand, stdin=bowtie2.stdout)
+    bowtie2.stdout.close()
+    waitForProcesses([bowtie2, samtools_sort], 'Read mapping failed')
+    splitStageMetrics('filter_unpaired', [unfilteredBam])
 
     # Use samtools view to filter out reads that didn't align
     samtools_viewCommand = ['samtools', 'view', '-u', '-F', '4', '-o', filteredBam, unfilteredBam]
-    samtools_view = subprocess.Popen(samtools_viewCommand, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    samtools_view.communicate()
-
-    if samtools_view.returncode != 0:
-        print 'Samtools view filtering failed'
-        exit()
+    samtools_view = startLoggedProcess(samtools_viewCommand)
+    waitForProcesses([samtools_view], 'Samtools view filtering failed')
+    deleteIntermediateFiles([unfilteredBam])
 
     # Use bedtools bamtofastq to convert the BAM file to two fastq files
-    bamtofastqCommand = ['bedtools', 'bamtofastq', '-i', filteredBam, '-fq', filteredReads]
-    bamtofastq = subprocess.Popen(bamtofastqCommand, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    bamtofastq.communicate()
+    bamtofastqReads = unpairedDir + '/filtered_reads_U.fastq' if args['compress'] else filteredReads
+    bamtofastqCommand = ['bedtools', 'bamtofastq', '-i', filteredBam, '-fq', bamtofastqReads]
+    bamtofastq = startLoggedProcess(bamtofastqCommand)
+    waitForProcesses([bamtofastq], 'BAM to FASTQ conversion failed')
+    deleteIntermediateFiles([filteredBam])
+
+    if args['compress']:
+        compressFile(bamtofastqReads, filteredReads)
+        deleteIntermediateFiles([bamtofastqReads])
+
+    if report:
+        print 'done'
+
+
+
+# Runs the mapping command and reads its SAM output as it is produced.  Pairs
+# are kept if either mate mapped and unpaired reads are kept if they mapped.
+# Kept reads are written straight to FASTQ, named the same way as Bedtools
+# bamtofastq names them.  This replaces the sort, view, merge and bamtofastq
+# steps, so no intermediate BAM files are made.
+def streamFilterAlignments(mappingCommand, readsFile1, readsFile2, readsFileU):
+    mapping = startLoggedProcess(mappingCommand, stdout=subprocess.PIPE)
+
+    reads1 = openReadsForWriting(readsFile1) if readsFile1 != None else None
+    reads2 = openReadsForWriting(readsFile2) if readsFile2 != None else None
+    readsU = openReadsForWriting(readsFileU) if readsFileU != None else None
+
+    # Bowtie 2 writes mates next to each other, so this only ever holds the
+    # one mate that is waiting for its partner.
+    waitingMates = {}
 
-    if bamtofastq.returncode != 0:
-        print 'BAM to FASTQ conversion failed'
+    for line in mapping.stdout:
+        if line[0] == '@':
+            continue
+        parts = line.split('\t', 11)
+        readName = parts[0]
+        flags = int(parts[1])
+
+        # Secondary and supplementary alignments repeat a read already seen.
+        if flags & 2304:
+            continue
+
+        sequence = parts[9]
+        qualities = parts[10].rstrip('\n')
+        if flags & 16:
+            sequence = getReverseComplement(sequence)
+            qualities = qualities[::-1]
+
+        if not flags & 1:
+            if not flags & 4 and readsU != None:
+                readsU.write('@' + readName + '\n' + sequence + '\n+\n' + qualities + '\n')
+            continue
+
+        mate = waitingMates.pop(readName, None)
+        if mate == None:
+            waitingMates[readName] = (flags, sequence, qualities)
+            continue
+
+        # Keep the pair unless both the read and its mate are unmapped.
+        if (flags & 12) == 12:
+            continue
+        if flags & 64:
+            first, second = (flags, sequence, qualities), mate
+        else:
+            first, second = mate, (flags, sequence, qualities)
+        reads1.write('@' + readName + '/1\n' + first[1] + '\n+\n' + first[2] + '\n')
+        reads2.write('@' + readName + '/2\n' + second[1] + '\n+\n' + second[2] + '\n')
+
+    for readsFile in (reads1, reads2, readsU):
+        if readsFile != None:
+            readsFile.close()
+
+    mapping.stdout.close()
+    waitForProcesses([mapping], 'Read mapping failed')
+
+
+
+# The read store is a packed copy of the input reads, made once in
+# OUTDIR/read_store and only rebuilt if the read files change.  Irsat's own
+# passes over the input reads (prefiltering, skipping recruited reads,
+# chunking and extracting recruited reads) unpack reads from the store instead
+# of parsing the FASTQ files, and FASTQ is only written for the reads handed
+# on to other tools.  Unpacking is only faster than reading gzipped FASTQ, so
+# uncompressed read files are read directly.
+def buildReadStore():
+    global args
+    global readStore
+
+    print '\nPacking read files:'
+
+    for readFile in (args['1'], args['2'], args['u']):
+        if readFile != None:
+            if isGzipped(readFile):
+                readStore[os.path.abspath(readFile)] = loadOrMakeStoredFile(readFile)
+            else:
+                print '   ' + getDateTimeString() + '  ' + os.path.basename(readFile) + ' is not gzipped, so it is read directly'
+
+
+baseEncodeTable = string.maketrans('ACGT', '0123')
+firstBaseDecodeTable = string.maketrans('0123456789abcdef', 'AAAACCCCGGGGTTTT')
+secondBaseDecodeTable = string.maketrans('0123456789abcdef', 'ACGTACGTACGTACGT')
+hexDigits = '0123456789abcdef'
+
+
+# Each read file is stored as fixed-width records, so a read's record is at
+# its ordinal times the record width:
+#  - bases: 2 bits per base, four bases per byte.  Bases other than A, C, G
+#    and T come back as N, from a separate N mask (a list of positions for
+#    each read, as most reads have none).
+#  - qualities: 4 bits per quality when the file has no more than 16
+#    distinct quality values (as binned qualities do), and 8 bits otherwise.
+# Read lengths and header lines are stored separately.  Bases are stored in
+# upper case and the '+' line is always written without a name.  The bases
+# and qualities are memory-mapped.
+def loadOrMakeStoredFile(readFile):
+    global outDir
+
+    print '   ' + getDateTimeString() + '  Packing ' + os.path.basename(readFile) + '...',
+    sys.stdout.flush()
+
+    storeDir = outDir + '/read_store'
+    if not os.path.exists(storeDir):
+        os.makedirs(storeDir)
+
+    storeName = storeDir + '/' + hashlib.md5(os.path.abspath(readFile)).hexdigest()[:12]
+    sourceFile = storeName + '.source'
+    source = os.path.abspath(readFile) + '\t' + str(os.path.getsize(readFile)) + '\t' + str(os.path.getmtime(readFile)) + '\n'
+
+    if os.path.isfile(sourceFile) and open(sourceFile, 'r').read() == source:
+        print 'loaded',
+    else:
+        makeStoredFile(readFile, storeName)
+
+        # The source is written last, so an interrupted store is rebuilt.
+        sourceOutput = open(sourceFile, 'w')
+        sourceOutput.write(source)
+        sourceOutput.close()
+        print 'done',
+
+    storedFile = json.load(open(storeName + '.json', 'r'))
+    for arrayName, typeCode in (('lengths', 'H'), ('header_offsets', 'L'), ('n_offsets', 'L'), ('n_positions', 'H')):
+        storedFile[arrayName] = loadArray(storeName + '.' + arrayName, typeCode)
+    for fileName in ('bases', 'qualities', 'headers'):
+        storedFile[fileName] = memoryMapFile(storeName + '.' + fileName)
+    storedFile['quality_decode_table'] = string.maketrans(hexDigits[:len(storedFile['quality_alphabet'])], str(storedFile['quality_alphabet']))
+
+    storedSize = getTotalFileSize(glob.glob(storeName + '.*'))
+    print '(' + str(storedFile['count']) + ' reads, ' + str(storedSize) + ' of ' + str(os.path.getsize(readFile)) + ' bytes)'
+    return storedFile
+
+
+# The file is read twice: first for the longest read and the quality values,
+# which set the record widths, and then to pack the reads.
+def makeStoredFile(readFile, storeName):
+    readCount = 0
+    maximumLength = 0
+    qualityValues = set()
+    for batch in readFastqBatches(readFile):
+        readCount += len(batch)
+        maximumLength = max([maximumLength] + [len(record[1].rstrip()) for record in batch])
+        qualityValues.update(''.join(record[3].rstrip() for record in batch))
+    if maximumLength > 65535:
+        print '\n\nERROR: the read store can only hold reads up to 65535 bp.'
         exit()
 
-    print 'done'
+    qualityAlphabet = ''.join(sorted(qualityValues))
+    halfByteQualities = len(qualityAlphabet) <= 16
+    baseWidth = (maximumLength + 3) // 4
+    qualityWidth = (maximumLength + 1) // 2 if halfByteQualities else maximumLength
+    qualityEncodeTable = string.maketrans(qualityAlphabet, hexDigits[:len(qualityAlphabet)]) if halfByteQualities else None
+
+    lengths = array.array('H')
+    headerOffsets = array.array('L', [0])
+    nOffsets = array.array('L', [0])
+    nPositions = array.array('H')
+    basesOutput = open(storeName + '.bases', 'wb')
+    qualitiesOutput = open(storeName + '.qualities', 'wb')
+    headersOutput = open(storeName + '.headers', 'wb')
+    for batch in readFastqBatches(readFile):
+        packedBases = []
+        packedQualities = []
+        for header, sequence, plus, qualities in batch:
+            sequence = sequence.rstrip().upper()
+            qualities = qualities.rstrip()
+            lengths.append(len(sequence))
+            headerOffsets.append(headerOffsets[-1] + len(header))
+
+            digits = sequence.translate(baseEncodeTable)
+            if digits.translate(None, '0123') != '':
+                nPositions.extend(i for i, base in enumerate(digits) if base not in '0123')
+                digits = re.sub(r'[^0123]', '0', digits)
+            nOffsets.append(len(nPositions))
+            digits += '0' * (4 * baseWidth - len(digits))
+            packedBases.append(binascii.unhexlify('%0*x' % (2 * baseWidth, int(digits, 4))) if baseWidth > 0 else '')
+
+            if qualityEncodeTable is not None:
+                qualityDigits = qualities.translate(qualityEncodeTable)
+                packedQualities.append(binascii.unhexlify(qualityDigits + '0' * (2 * qualityWidth - len(qualityDigits))))
+            else:
+                packedQualities.append(qualities + '\x00' * (qualityWidth - len(qualities)))
+        basesOutput.write(''.join(packedBases))
+        qualitiesOutput.write(''.join(packedQualities))
+        headersOutput.write(''.join(record[0] for record in batch))
+    basesOutput.close()
+    qualitiesOutput.close()
+    headersOutput.close()
+
+    saveArray(lengths, storeName + '.lengths')
+    saveArray(headerOffsets, storeName + '.header_offsets')
+    saveArray(nOffsets, storeName + '.n_offsets')
+    saveArray(nPositions, storeName + '.n_positions')
+    storeInfo = {'count': readCount, 'base_width': baseWidth, 'quality_width': qualityWidth,
+                 'quality_alphabet': qualityAlphabet if qualityEncodeTable is not None else ''}
+    json.dump(storeInfo, open(storeName + '.json', 'w'))
+
+
+# Returns the records (as tuples of their four lines) for a range of read
+# ordinals.  The bases and qualities of the whole range are unpacked at once,
+# and the Ns are put back before the records are cut out.
+def getStoredRecords(storedFile, start, end):
+    baseWidth = storedFile['base_width']
+    qualityWidth = storedFile['quality_width']
+    bases = decodeBases(storedFile['bases'][start * baseWidth:end * baseWidth])
+    qualities = storedFile['qualities'][start * qualityWidth:end * qualityWidth]
+    if storedFile['quality_alphabet'] != '':
+        qualities = binascii.hexlify(qualities).translate(storedFile['quality_decode_table'])
+        qualityWidth *= 2
+    baseWidth *= 4
+
+    nOffsets = storedFile['n_offsets']
+    nPositions = storedFile['n_positions']
+    for i in range(nOffsets[start], nOffsets[end]):
+        ordinal = bisect.bisect_right(nOffsets, i, start, end + 1) - 1
+        bases[(ordinal - start) * baseWidth + nPositions[i]] = 'N'
+    bases = str(bases)
+
+    lengths = storedFile['lengths']
+    headerOffsets = storedFile['header_offsets']
+    headers = storedFile['headers']
+    return [(headers[headerOffsets[ordinal]:headerOffsets[ordinal + 1]],
+             bases[i * baseWidth:i * baseWidth + lengths[ordinal]] + '\n', '+\n',
+             qualities[i * qualityWidth:i * qualityWidth + lengths[ordinal]] + '\n')
+            for i, ordinal in enumerate(range(start, end))]
+
+
+# Unpacks two-bit bases into a bytearray.  Each hex digit of the packed bytes
+# holds two bases, so the first and second bases of every digit are translated
+# separately and interleaved, without a Python step per base.
+def decodeBases(packedBases):
+    digits = binascii.hexlify(packedBases)
+    bases = bytearray(2 * len(digits))
+    bases[0::2] = digits.translate(firstBaseDecodeTable)
+    bases[1::2] = digits.translate(secondBaseDecodeTable)
+    return bases
+
+
+
+# Makes a byte-offset index of each input read file so that any read can be
+# pulled from the input by its ordinal (its position in the file).  The index
+# is saved in the output directory and only rebuilt if the read files change.
+def buildReadIndex():
+    global args
+    global readIndex
 
+    print '\nIndexing read files:'
 
+    if args['1'] != None and args['2'] != None:
+        readIndex['paired'] = loadOrMakeReadIndex('paired', [args['1'], args['2']])
+    if args['u'] != None:
+        readIndex['unpaired'] = loadOrMakeReadIndex('unpaired', [args['u']])
+
+
+
+# Each index holds an offset array for each of its files and a sorted array
+# of name keys.  A name key has a 32-bit hash of the read name in its upper
+# half and the read's ordinal in its lower half, so a name can be looked up
+# with a bisect and then checked against the read file itself.  Gzipped read
+# files can't be memory-mapped, so for those a second, independent 32-bit
+# hash of each read's name is stored instead, to check matches against.
+def loadOrMakeReadIndex(indexName, readFiles):
+    global outDir
+
+    print '   ' + getDateTimeString() + '  Indexing ' + indexName + ' reads...',
+    sys.stdout.flush()
+
+    indexDir = outDir + '/read_index'
+    if not os.path.exists(indexDir):
+        os.makedirs(indexDir)
+
+    sourceFile = indexDir + '/' + indexName + '.source'
+    namesFile = indexDir + '/' + indexName + '.names'
+    checksFile = indexDir + '/' + indexName + '.checks'
+    offsetsFiles = [indexDir + '/' + indexName + '_' + str(i + 1) + '.offsets' for i in range(len(readFiles))]
+
+    # Unpaired read names keep their /1 or /2 suffix.  Older unpaired indices
+    # didn't, so the source records it and they are rebuilt.
+    paired = indexName == 'paired'
+    source = '' if paired else 'full read names\n'
+    for readFile in readFiles:
+        source += os.path.abspath(readFile) + '\t' + str(os.path.getsize(readFile)) + '\t' + str(os.path.getmtime(readFile)) + '\n'
+
+    if os.path.isfile(sourceFile) and open(sourceFile, 'r').read() == source:
+        offsets = [loadArray(offsetsFile) for offsetsFile in offsetsFiles]
+        nameKeys = loadArray(namesFile)
+        nameChecks = loadArray(checksFile, 'I')
+        print 'loaded',
+    else:
+        offsets = []
+        nameKeys = array.array('L')
+        nameChecks = array.array('I')
+        for readFile in readFiles:
+            if len(offsets) == 0:
+                offsets.append(indexFastqOffsets(readFile, nameKeys, nameChecks if isGzipped(readFile) else None, paired))
+            else:
+                offsets.append(indexFastqOffsets(readFile, None, None, paired))
+        if len(set(len(fileOffsets) for fileOffsets in offsets)) > 1:
+            print '\n\nERROR: the paired read files do not contain the same number of reads.'
+            exit()
+        nameKeys = sortArrayInChunks(nameKeys)
+
+        for fileOffsets, offsetsFile in zip(offsets, offsetsFiles):
+            saveArray(fileOffsets, offsetsFile)
+        saveArray(nameKeys, namesFile)
+        saveArray(nameChecks, checksFile)
+
+        # The source is written last, so an interrupted index is rebuilt.
+        sourceOutput = open(sourceFile, 'w')
+        sourceOutput.write(source)
+        sourceOutput.close()
+        print 'done',
+
+    readCount = len(offsets[0]) - 1
+    print '(' + str(readCount) + ' reads)'
+
+    return {'files': readFiles,
+            'maps': [memoryMapFile(readFile) for readFile in readFiles],
+            'offsets': offsets,
+            'names': nameKeys,
+            'checks': nameChecks,
+            'count': readCount,
+            'paired': paired}
+
+
+
+# Returns the byte offset of every FASTQ record, plus the file size at the
+# end.  If nameKeys is given, the name key of each record is added to it, and
+# likewise for nameChecks.  The offsets of a gzipped file are offsets in its
+# uncompressed data, so they are only used for counting.
+def indexFastqOffsets(fastqFile, nameKeys, nameChecks, paired):
+    offsets = array.array('L')
+    position = 0
+    fastq = openReadFile(fastqFile)
+    for lineNumber, line in enumerate(fastq):
+        if lineNumber % 4 == 0:
+            if nameKeys is not None:
+                nameKeys.append((getStableReadNameHash(line, paired) << 32) | len(offsets))
+            if nameChecks is not None:
+                nameChecks.append(getReadNameCheck(line, paired))
+            offsets.append(position)
+        position += len(line)
+    offsets.append(position)
+    fastq.close()
+    return offsets
+
+
+
+# Finds the ordinal of a read (given by its header line) in a read index, or
+# returns None if it is not there.  Mappers like Bowtie 2 drop a /1 or /2
+# suffix from read names, so an unpaired read x/1 or x/2 can come back as x.
+# Then the read with that suffix whose sequence matches is used, or if the
+# sequences can't be compared (for gzipped reads without a read store), the
+# first one not already in the bitmap.
+def findReadOrdinal(headerLine, index, sequenceLine, bitmap):
+    paired = index['paired']
+    ordinal = findReadNameOrdinal(headerLine, index)
+    if ordinal is not None or paired:
+        return ordinal
+
+    readName = getReadName(headerLine, False)
+    candidates = [findReadNameOrdinal('@' + readName + suffix, index) for suffix in ('/1', '/2')]
+    candidates = [candidate for candidate in candidates if candidate is not None]
+    matching = [candidate for candidate in candidates if getIndexedSequence(candidate, index) in (None, sequenceLine.strip().upper())]
+    notInBitmap = [candidate for candidate in matching if not bitmap[candidate >> 3] & (1 << (candidate & 7))]
+    return (notInBitmap + matching + [None])[0]
+
+
+def findReadNameOrdinal(headerLine, index):
+    paired = index['paired']
+    readName = getReadName(headerLine, paired)
+    nameHash = getStableReadNameHash(headerLine, paired)
+    nameKeys = index['names']
+    firstFileMap = index['maps'][0]
+    firstFileOffsets = index['offsets'][0]
+
+    i = bisect.bisect_left(nameKeys, nameHash << 32)
+    while i < len(nameKeys) and nameKeys[i] >> 32 == nameHash:
+        ordinal = nameKeys[i] & 0xFFFFFFFF
+        if firstFileMap is None:
+            if index['checks'][ordinal] == getReadNameCheck(headerLine, paired):
+                return ordinal
+        else:
+            start = firstFileOffsets[ordinal]
+            end = firstFileMap.find('\n', start)
+            if getReadName(firstFileMap[start:end], paired) == readName:
+                return ordinal
+        i += 1
+    return None
+
+
+def getIndexedSequence(ordinal, index):
+    storedFile = readStore.get(os.path.abspath(index['files'][0]))
+    if storedFile is not None:
+        return getStoredRecords(storedFile, ordinal, ordinal + 1)[0][1].strip()
+    fileMap = index['maps'][0]
+    if fileMap is None:
+        return None
+    record = fileMap[index['offsets'][0][ordinal]:index['offsets'][0][ordinal + 1]]
+    return record.split('\n')[1].strip().upper()
+
+
+
+# This is used in place of addPreviousReads when there is a read index.  The
+# reads recruited so far are stored as a bitmap over read ordinals in each
+# iteration directory.  The reads found by this iteration's mapping are added
+# to the previous iteration's bitmap (so it only ever gains reads) and then
+# the filtered read files are rewritten from the input files, in their
+# original order.
+def updateRecruitedReads(iteration, iterDir):
+    global readIndex
+
+    print '   ' + getDateTimeString() + '  Collecting recruited reads...',
+    sys.stdout.flush()
+
+    filteredReads = {'paired': [getFilteredReadsFile(iterDir, 'R1'), getFilteredReadsFile(iterDir, 'R2')],
+                     'unpaired': [getFilteredReadsFile(iterDir, 'U')]}
+    previousIterDir = getIterationDirectoryFullPath(iteration - 1)
 
+    recruitedCount = 0
+    for indexName in ('paired', 'unpaired'):
+        if indexName not in readIndex:
+            continue
+        index = readIndex[indexName]
+        readFiles = filteredReads[indexName]
+
+        bitmapFile = iterDir + '/recruited_' + indexName + '.bitmap'
+        previousBitmapFile = previousIterDir + 'recruited_' + indexName + '.bitmap'
+        previousReadsFile = previousIterDir + os.path.basename(readFiles[0])
+
+        bitmap = bytearray((index['count'] + 7) // 8)
+        if iteration > 1 and os.path.isfile(previousBitmapFile):
+            bitmap = bytearray(open(previousBitmapFile, 'rb').read())
+        elif iteration > 1 and os.path.isfile(previousReadsFile):
+            addReadsToBitmap(previousReadsFile, index, bitmap)
+        addReadsToBitmap(readFiles[0], index, bitmap)
+
+        bitmapOutput = open(bitmapFile, 'wb')
+        bitmapOutput.write(bitmap)
+        bitmapOutput.close()
+
+        recruitedCount += writeReadsInBitmap(index, bitmap, readFiles) * len(readFiles)
+
+    print 'done (' + str(recruitedCount) + ' reads)'
+
+
+
+def addReadsToBitmap(fastqFile, index, bitmap):
+    for batch in readFastqBatches(fastqFile):
+        for record in batch:
+            ordinal = findReadOrdinal(record[0], index, record[1], bitmap)
+            if ordinal is None:
+                print '\n\nERROR: the following read is not in the input read files:'
+                print record[0].strip()
+                exit()
+            bitmap[ordinal >> 3] |= 1 << (ordinal & 7)
+
+
+
+# Writes each read with a set bit to the output files, copying the records
+# directly from the memory-mapped input files.  Returns the number of reads
+# (or pairs) written.
+def writeReadsInBitmap(index, bitmap, outputFiles):
+    storedFiles = [readStore.get(os.path.abspath(readFile)) for readFile in index['files']]
+    if None not in storedFiles:
+        return writeStoredReadsInBitmap(storedFiles, bitmap, outputFiles)
+    if None in index['maps']:
+        return streamReadsInBitmap(index, bitmap, outputFiles)
+
+    outputs = [openReadsForWriting(outputFile) for outputFile in outputFiles]
+    writtenCount = 0
+
+    # Most of the bitmap is empty, so only the non-zero bytes are visited.
+    for nonZeroByte in re.finditer(r'[^\x00]', bitmap):
+        byteIndex = nonZeroByte.start()
+        byte = bitmap[byteIndex]
+        for bit in range(8):
+            if not byte & (1 << bit):
+                continue
+            ordinal = byteIndex * 8 + bit
+            for fileMap, offsets, output in zip(index['maps'], index['offsets'], outputs):
+                record = fileMap[offsets[ordinal]:offsets[ordinal + 1]]
+                if not record.endswith('\n'):
+                    record += '\n'
+                output.write(record)
+            writtenCount += 1
+
+    for output in outputs:
+        output.close()
+    return writtenCount
+
+
+
+# With a read store, each read in the bitmap is unpacked from the store by its
+# ordinal, which works for gzipped read files too.
+def writeStoredReadsInBitmap(storedFiles, bitmap, outputFiles):
+    outputs = [openReadsForWriting(outputFile) for outputFile in outputFiles]
+    writtenCount = 0
+
+    for nonZeroByte in re.finditer(r'[^\x00]', bitmap):
+        byteIndex = nonZeroByte.start()
+        byte = bitmap[byteIndex]
+        for bit in range(8):
+            if not byte & (1 << bit):
+                continue
+            ordinal = byteIndex * 8 + bit
+            for storedFile, output in zip(storedFiles, outputs):
+                output.write(''.join(getStoredRecords(storedFile, ordinal, ordinal + 1)[0]))
+            writtenCount += 1
+
+    for output in outputs:
+        output.close()
+    return writtenCount
+
+
+
+# Gzipped read files can't be memory-mapped, so the reads in the bitmap are
+# picked out while streaming through the files.
+def streamReadsInBitmap(index, bitmap, outputFiles):
+    outputs = [openReadsForWriting(outputFile) for outputFile in outputFiles]
+    writtenCount = 0
+
+    ordinal = 0
+    for batches in itertools.izip(*[readFastqBatches(readFile) for readFile in index['files']]):
+        for records in zip(*batches):
+            if bitmap[ordinal >> 3] & (1 << (ordinal & 7)):
+                for record, output in zip(records, outputs):
+                    output.write(''.join(record))
+                writtenCount += 1
+            ordinal += 1
+
+    for output in outputs:
+        output.close()
+    return writtenCount
 
 
 
@@ -426,19 +2759,18 @@ def mapUnpairedReads(iteration, iterDir):
 # filtered reads.  Any that aren't included in this iteration should be added
 # so the read set always grows, never shrinks.
 def addPreviousReads(iteration, iterDir):
-    readsMate1 = iterDir + '/filtered_reads_R1.fastq'
-    readsMate2 = iterDir + '/filtered_reads_R2.fastq'
-    readsUnpaired = iterDir + '/filtered_reads_U.fastq'
+    readsMate1 = getFilteredReadsFile(iterDir, 'R1')
+    readsMate2 = getFilteredReadsFile(iterDir, 'R2')
+    readsUnpaired = getFilteredReadsFile(iterDir, 'U')
     
     previousIterDir = getIterationDirectoryFullPath(iteration - 1)
-    previousReadsMate1 = previousIterDir + 'filtered_reads_R1.fastq'
-    previousReadsMate2 = previousIterDir + 'filtered_reads_R2.fastq'
-    previousReadsUnpaired = previousIterDir + 'filtered_reads_U.fastq'
+    previousReadsMate1 = getFilteredReadsFile(previousIterDir, 'R1')
+    previousReadsMate2 = getFilteredReadsFile(previousIterDir, 'R2')
+    previousReadsUnpaired = getFilteredReadsFile(previousIterDir, 'U')
     
     # Paired reads
     if args['1'] != None and args['2'] != None:
-        addReadsFromOneFileToAnother(previousReadsMate1, readsMate1)
-        addReadsFromOneFileToAnother(previousReadsMate2, readsMate2)
+        addReadPairsFromFilesToOthers(previousReadsMate1, previousReadsMate2, readsMate1, readsMate2)
 
     # Unpaired reads
     if args['u'] != None:
@@ -450,38 +2782,85 @@ def addPreviousReads(iteration, iterDir):
 # second file to the second file.  I.e. it merges the read files into the
 # second, without any repeats.
 def addReadsFromOneFileToAnother(sourceFile, destinationFile):
-    readsAlreadyInDestination = makeDictionaryOfReadNames(destinationFile)
-    
-    source = open(sourceFile, 'r')
-    destination = open(destinationFile, 'a')
+    readsAlreadyInDestination = makeReadNameHashArray(destinationFile, False)
 
-    addToDestination = False
-    for line in source:
-        if line[0] == '@':
-            if line.strip() not in readsAlreadyInDestination:
-                addToDestination = True
-            else:
-                addToDestination = False
-        if addToDestination:
-            destination.write(line)
+    destination = openReadsForWriting(destinationFile, 'a')
+    for batch in readFastqBatches(sourceFile):
+        newRecords = [''.join(record) for record in batch
+                      if not isHashInSortedArray(getReadNameHash(record[0], False), readsAlreadyInDestination)]
+        destination.write(''.join(newRecords))
+    destination.close()
 
 
 
+# This function does the same as addReadsFromOneFileToAnother, but for paired
+# reads.  The two source files are read in lockstep and a pair is added to
+# both destination files unless it is already there.
+def addReadPairsFromFilesToOthers(sourceFile1, sourceFile2, destinationFile1, destinationFile2):
+    pairsAlreadyInDestination = makeReadNameHashArray(destinationFile1)
 
-# This function looks at all reads in a FASTQ file (the lines that start with
-# @) and stores their names in a dictionary.
-def makeDictionaryOfReadNames(fastqFile):
-    returnDict = {}
-    fastq = open(fastqFile, 'r')
+    destination1 = openReadsForWriting(destinationFile1, 'a')
+    destination2 = openReadsForWriting(destinationFile2, 'a')
+    for batch1, batch2 in zip(readFastqBatches(sourceFile1), readFastqBatches(sourceFile2)):
+        newRecords1 = []
+        newRecords2 = []
+        for record1, record2 in zip(batch1, batch2):
+            if not isHashInSortedArray(getReadNameHash(record1[0]), pairsAlreadyInDestination):
+                newRecords1.append(''.join(record1))
+                newRecords2.append(''.join(record2))
+        destination1.write(''.join(newRecords1))
+        destination2.write(''.join(newRecords2))
+    destination1.close()
+    destination2.close()
 
-    for line in fastq:
-        if line[0] == '@':
-            readName = line.strip()
-            returnDict[readName] = ""
 
-    return returnDict
-    
 
+# This function looks at all reads in a FASTQ file and returns a sorted array
+# of 64-bit hashes of their names.  This takes far less memory than storing
+# the names themselves.
+def makeReadNameHashArray(fastqFile, paired=True):
+    readNameHashes = array.array('L')
+    for batch in readFastqBatches(fastqFile):
+        readNameHashes.extend(getReadNameHash(record[0], paired) for record in batch)
+    return sortArrayInChunks(readNameHashes)
+
+
+
+# A read's name is the first word of its header line.  For paired reads it is
+# without any /1 or /2 suffix, so both reads in a pair give the same hash, but
+# an unpaired read file can hold both x/1 and x/2, which are different reads.
+# Python's string hash
+# is 64 bits on 64-bit platforms, so collisions are not a practical concern,
+# but it is only consistent within one process and must not be saved.
+def getReadNameHash(headerLine, paired=True):
+    return hash(getReadName(headerLine, paired)) & 0xFFFFFFFFFFFFFFFF
+
+
+
+# Unlike getReadNameHash, this hash is the same in every process, so it can
+# be saved in the read index.
+def getStableReadNameHash(headerLine, paired=True):
+    return zlib.crc32(getReadName(headerLine, paired)) & 0xFFFFFFFF
+
+
+
+def getReadNameCheck(headerLine, paired=True):
+    return struct.unpack('<I', hashlib.md5(getReadName(headerLine, paired)).digest()[:4])[0]
+
+
+
+def getReadName(headerLine, paired=True):
+    readName = headerLine[1:].split(None, 1)[0]
+    if paired and (readName.endswith('/1') or readName.endswith('/2')):
+        readName = readName[:-2]
+    return readName
+
+
+
+def isHashInSortedArray(value, sortedArray):
+    i = bisect.bisect_left(sortedArray, value)
+    return i < len(sortedArray) and sortedArray[i] == value
+    
 
 
 
@@ -497,38 +2876,22 @@ def assemble(iteration, iterDir):
     print '   ' + getDateTimeString() + '  Assembling...',
     sys.stdout.flush()
 
-    # Prepare file paths
-    readsMate1 = iterDir + '/filtered_reads_R1.fastq'
-    readsMate2 = iterDir + '/filtered_reads_R2.fastq'
-    readsUnpaired = iterDir + '/filtered_reads_U.fastq'
-
     # Make a folder for the assembly
-    assemblyDir = iterDir + '/3-assembly'
+    assemblyDir = getWorkingDirectory(iterDir) + '/3-assembly'
     os.makedirs(assemblyDir)
 
-    # Paired reads only
-    if args['1'] != None and args['2'] != None and args['u'] == None:
-        assemblyCommand = commands['assemble_paired'][:]
-
-    # Unpaired reads only
-    elif args['1'] == None and args['2'] == None and args['u'] != None:
-        assemblyCommand = commands['assemble_unpaired'][:]
-
-    # Both paired and unpaired reads
-    else:
-        assemblyCommand = commands['assemble_both'][:]
-
-    # Replace variables in the assembly command.
-    assemblyCommand[:] = [replacePartOfCommand(line, 'DIRECTORY', assemblyDir) for line in assemblyCommand]
-    assemblyCommand[:] = [replacePartOfCommand(line, 'PAIRED_READS_FILE_1', readsMate1) for line in assemblyCommand]
-    assemblyCommand[:] = [replacePartOfCommand(line, 'PAIRED_READS_FILE_2', readsMate2) for line in assemblyCommand]
-    assemblyCommand[:] = [replacePartOfCommand(line, 'UNPAIRED_READS_FILE', readsUnpaired) for line in assemblyCommand]
+    assemblyCommand = getAssemblyCommand(iteration, iterDir, str(args['threads']), str(args['memory']))
 
     # Execute each line of the assembly commands.  For some assemblers, this
     # may only be one line.  Others, like Velvet, may have multiple lines.
+    # Assemblers which use OpenMP, like Velvet, take their thread count from
+    # the environment.
+    assemblyEnvironment = dict(os.environ)
+    assemblyEnvironment['OMP_NUM_THREADS'] = str(args['threads'])
+
     for command in assemblyCommand:
-        assemblyProcess = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        out, err = assemblyProcess.communicate()
+        assemblyProcess = startLoggedProcess(command, env=assemblyEnvironment)
+        waitForProcesses([assemblyProcess], 'Assembly failed')
 
     # Copy the contigs file to the iteration directory
     contigsFile = assemblyDir + '/' + commands['assemble_contigs']
@@ -559,18 +2922,666 @@ def assemble(iteration, iterDir):
 
 
 
-def deleteTemporaryDirectories(iterDir):
-    indexDir = iterDir + '/1_mapping_index'
-    pairedDir = iterDir + '/2-paired_read_alignments'
-    unpairedDir = iterDir + '/2-unpaired_read_alignments'
-    assemblyDir = iterDir + '/3-assembly'
+# Returns the assembly command lines for the types of reads being used, with
+# their variables replaced.
+def getAssemblyCommand(iteration, iterDir, threads, memory):
+    global args
+    global commands
+    global assemblyReadFiles
+
+    assemblyCommand = getAssemblyCommandTemplate(iteration)[:]
+
+    # Replace variables in the assembly command.  The previous assembly's
+    # files only exist after the first iteration, so optional groups which
+    # use them are dropped until then.
+    previousAssemblyFiles = getPreviousAssemblyFiles(iteration)
+    assemblyCommand[:] = [replaceOptionalGroups(line, previousAssemblyFiles) for line in assemblyCommand]
+    for placeholder, fileName in previousAssemblyFiles.items():
+        if fileName is not None:
+            assemblyCommand[:] = [replacePartOfCommand(line, placeholder, fileName) for line in assemblyCommand]
+    assemblyCommand[:] = [replacePartOfCommand(line, 'DIRECTORY', getWorkingDirectory(iterDir) + '/3-assembly') for line in assemblyCommand]
+    assemblyCommand[:] = [replacePartOfCommand(line, 'THREADS', threads) for line in assemblyCommand]
+    assemblyCommand[:] = [replacePartOfCommand(line, 'MEMORY', memory) for line in assemblyCommand]
+    assemblyCommand[:] = [replacePartOfCommand(line, 'PAIRED_READS_FILE_1', assemblyReadFiles['1']) for line in assemblyCommand]
+    assemblyCommand[:] = [replacePartOfCommand(line, 'PAIRED_READS_FILE_2', assemblyReadFiles['2']) for line in assemblyCommand]
+    assemblyCommand[:] = [replacePartOfCommand(line, 'UNPAIRED_READS_FILE', assemblyReadFiles['u']) for line in assemblyCommand]
+    return assemblyCommand
+
+
+
+# Returns the assembly command lines for the types of reads being used, before
+# their variables are replaced.
+def getAssemblyCommandTemplate(iteration):
+    global args
 
-    shutil.rmtree(indexDir)
-    if os.path.exists(pairedDir):
-        shutil.rmtree(pairedDir)
-    if os.path.exists(unpairedDir):
-        shutil.rmtree(unpairedDir)
-    shutil.rmtree(assemblyDir)
+    # Paired reads only
+    if args['1'] != None and args['2'] != None and args['u'] == None:
+        return getIterationCommand('assemble_paired', iteration)
+
+    # Unpaired reads only
+    elif args['1'] == None and args['2'] == None and args['u'] != None:
+        return getIterationCommand('assemble_unpaired', iteration)
+
+    # Both paired and unpaired reads
+    else:
+        return getIterationCommand('assemble_both', iteration)
+
+
+
+# Returns the previous iteration's contigs and graph files, keyed by their
+# placeholders, or None for a file which doesn't exist (in the first
+# iteration, or if no graph is configured).
+def getPreviousAssemblyFiles(iteration):
+    global commands
+
+    previousAssemblyFiles = {'PREVIOUS_CONTIGS': None, 'PREVIOUS_GRAPH': None}
+    if iteration > 1:
+        previousIterDir = getIterationDirectoryFullPath(iteration - 1)
+        contigsFile = previousIterDir + os.path.basename(commands['assemble_contigs'])
+        if os.path.isfile(contigsFile):
+            previousAssemblyFiles['PREVIOUS_CONTIGS'] = contigsFile
+        if 'assemble_graph' in commands and commands['assemble_graph'] != "":
+            graphFile = previousIterDir + os.path.basename(commands['assemble_graph'])
+            if os.path.isfile(graphFile):
+                previousAssemblyFiles['PREVIOUS_GRAPH'] = graphFile
+    return previousAssemblyFiles
+
+
+# Parts of a command can be put in square brackets, like
+# [--trusted-contigs PREVIOUS_CONTIGS].  The brackets are removed if every
+# placeholder in the group has a value, and the whole group is dropped if
+# any of them doesn't.
+def replaceOptionalGroups(command, values):
+    returnCommand = []
+    group = None
+    for part in command:
+        if group is None and part.startswith('['):
+            group = []
+            part = part[1:]
+        if group is None:
+            returnCommand.append(part)
+            continue
+        groupEnds = part.endswith(']')
+        if groupEnds:
+            part = part[:-1]
+        if part != '':
+            group.append(part)
+        if groupEnds:
+            if all(values.get(groupPart, '') is not None for groupPart in group):
+                returnCommand += group
+            group = None
+    if group is not None:
+        print "\n\nERROR: an optional group in this command has no closing bracket:"
+        print ' '.join(command)
+        exit()
+    return returnCommand
+
+
+
+# The reads given to the assembler are the filtered reads, unless they are
+# normalised first.  Either way, the filtered reads are left as they are, to
+# be carried forward to the next iteration.
+def setAssemblyReadFiles(iterDir):
+    global assemblyReadFiles
+    assemblyReadFiles = {'1': getFilteredReadsFile(iterDir, 'R1'),
+                         '2': getFilteredReadsFile(iterDir, 'R2'),
+                         'u': getFilteredReadsFile(iterDir, 'U')}
+
+
+
+# Digital normalisation: the filtered reads are streamed in order, and a read
+# is only kept if the median count of its k-mers (among the reads kept so
+# far) is below the target depth.  A pair is kept if either mate is, so the
+# pairs stay intact.  This caps the coverage of regions that have already
+# been assembled many times over, while leaving thinly covered regions (like
+# the growing contig ends) alone.  K-mers are counted on both strands.
+def normaliseReads(iterDir):
+    global args
+    global assemblyReadFiles
+
+    print '   ' + getDateTimeString() + '  Normalising reads...',
+    sys.stdout.flush()
+
+    normaliseDir = getWorkingDirectory(iterDir) + '/2-normalised_reads'
+    os.makedirs(normaliseDir)
+
+    depth = args['normalise']
+    kmerSize = args['normalise_k']
+    kmerCounts = collections.defaultdict(int)
+    readCount = 0
+    keptCount = 0
+
+    if args['1'] != None and args['2'] != None:
+        normalised1 = normaliseDir + '/' + os.path.basename(assemblyReadFiles['1'])
+        normalised2 = normaliseDir + '/' + os.path.basename(assemblyReadFiles['2'])
+        output1 = openReadsForWriting(normalised1)
+        output2 = openReadsForWriting(normalised2)
+        for batch1, batch2 in itertools.izip(readFastqBatches(assemblyReadFiles['1']), readFastqBatches(assemblyReadFiles['2'])):
+            kept1 = []
+            kept2 = []
+            for record1, record2 in zip(batch1, batch2):
+                kmers1 = getCanonicalKmerHashes(record1[1].rstrip(), kmerSize)
+                kmers2 = getCanonicalKmerHashes(record2[1].rstrip(), kmerSize)
+                if getMedianKmerCount(kmers1, kmerCounts) < depth or getMedianKmerCount(kmers2, kmerCounts) < depth:
+                    for kmer in kmers1 + kmers2:
+                        kmerCounts[kmer] += 1
+                    kept1.append(''.join(record1))
+                    kept2.append(''.join(record2))
+            output1.write(''.join(kept1))
+            output2.write(''.join(kept2))
+            readCount += 2 * len(batch1)
+            keptCount += 2 * len(kept1)
+        output1.close()
+        output2.close()
+        assemblyReadFiles['1'] = normalised1
+        assemblyReadFiles['2'] = normalised2
+
+    if args['u'] != None:
+        normalisedU = normaliseDir + '/' + os.path.basename(assemblyReadFiles['u'])
+        outputU = openReadsForWriting(normalisedU)
+        for batch in readFastqBatches(assemblyReadFiles['u']):
+            kept = []
+            for record in batch:
+                kmers = getCanonicalKmerHashes(record[1].rstrip(), kmerSize)
+                if getMedianKmerCount(kmers, kmerCounts) < depth:
+                    for kmer in kmers:
+                        kmerCounts[kmer] += 1
+                    kept.append(''.join(record))
+            outputU.write(''.join(kept))
+            readCount += len(batch)
+            keptCount += len(kept)
+        outputU.close()
+        assemblyReadFiles['u'] = normalisedU
+
+    print 'done (' + str(keptCount) + ' of ' + str(readCount) + ' reads kept)'
+    return keptCount
+
+
+
+# A k-mer and its reverse complement count as the same k-mer.  Hashes stand
+# in for the k-mers themselves to save memory.
+def getCanonicalKmerHashes(sequence, kmerSize):
+    reverseComplement = getReverseComplement(sequence)
+    length = len(sequence)
+    return [hash(min(sequence[i:i+kmerSize], reverseComplement[length-kmerSize-i:length-i]))
+            for i in range(length - kmerSize + 1)]
+
+
+# A read too short to have any k-mers is always kept.
+def getMedianKmerCount(kmers, kmerCounts):
+    if len(kmers) == 0:
+        return 0
+    counts = sorted(kmerCounts.get(kmer, 0) for kmer in kmers)
+    return counts[len(counts) // 2]
+
+
+
+# Copies the previous iteration's contigs (and graph, if there is one) into
+# this iteration's directory instead of running the assembler.
+def reusePreviousAssembly(iteration, iterDir):
+    global commands
+    global lastContigsFile
+
+    print '   ' + getDateTimeString() + '  Assembling... skipped (no new reads, reusing the previous assembly)'
+
+    previousIterDir = getIterationDirectoryFullPath(iteration - 1)
+    fileNames = [os.path.basename(commands['assemble_contigs'])]
+    if 'assemble_graph' in commands and commands['assemble_graph'] != "":
+        fileNames.append(os.path.basename(commands['assemble_graph']))
+
+    for fileName in fileNames:
+        shutil.copyfile(previousIterDir + fileName, iterDir + '/' + fileName)
+    lastContigsFile = getIterationContigsFile(iteration)
+
+
+
+# The filtered read files are gzipped if the user asked for compression.
+def getFilteredReadsFile(iterDir, readType):
+    global args
+    fileName = iterDir.rstrip('/') + '/filtered_reads_' + readType + '.fastq'
+    if args['compress']:
+        fileName += '.gz'
+    return fileName
+
+
+
+# Returns the filtered read files in an iteration directory, for the types of
+# reads being used.
+def getFilteredReadsFiles(iterDir):
+    global args
+
+    readsFiles = []
+    if args['1'] != None and args['2'] != None:
+        readsFiles += [getFilteredReadsFile(iterDir, 'R1'), getFilteredReadsFile(iterDir, 'R2')]
+    if args['u'] != None:
+        readsFiles.append(getFilteredReadsFile(iterDir, 'U'))
+    return readsFiles
+
+
+
+# The recruited read set only ever grows, so if its size hasn't changed, the
+# reads are the same as the previous iteration's.  The reads are counted once,
+# when the mapping stage writes them, and the count is kept in the mapping
+# checkpoint.  They are only counted again if there is no checkpoint.
+def getRecruitedReadCount(iteration):
+    global recruitedReadCounts
+
+    iterDir = getIterationDirectoryFullPath(iteration)
+    if iterDir not in recruitedReadCounts:
+        state = loadCheckpoints(iterDir).get('mapping', {}).get('state') or {}
+        if 'recruited_reads' in state:
+            recruitedReadCounts[iterDir] = state['recruited_reads']
+        else:
+            countRecruitedReads(iteration)
+    return recruitedReadCounts[iterDir]
+
+
+def countRecruitedReads(iteration):
+    global args
+    global recruitedReadCounts
+
+    iterDir = getIterationDirectoryFullPath(iteration)
+    readCount = 0
+    if args['1'] != None and args['2'] != None:
+        readCount += 2 * countFastqRecords(getFilteredReadsFile(iterDir, 'R1'))
+    if args['u'] != None:
+        readCount += countFastqRecords(getFilteredReadsFile(iterDir, 'U'))
+    recruitedReadCounts[iterDir] = readCount
+    return readCount
+
+
+
+# Compares an iteration with the one before to see if the run is still making
+# progress.  It has converged when the contig set is unchanged, or when the
+# recruited reads and the total contig length both grew by no more than the
+# minimum growth percentage.
+def hasConverged(iteration):
+    global args
+
+    readCount = getRecruitedReadCount(iteration)
+    contigCount, contigLength, contigSetHash = getContigStats(getIterationContigsFile(iteration))
+
+    message = '   Recruited reads: ' + str(readCount) + ', contigs: ' + str(contigCount) + ', total length: ' + str(contigLength) + ' bp'
+
+    previousContigsFile = getIterationContigsFile(iteration - 1)
+    if iteration == 1 or not os.path.isfile(previousContigsFile):
+        print message
+        return False
+
+    previousReadCount = getRecruitedReadCount(iteration - 1)
+    previousContigCount, previousContigLength, previousContigSetHash = getContigStats(previousContigsFile)
+
+    readGrowth = getGrowthPercentage(previousReadCount, readCount)
+    lengthGrowth = getGrowthPercentage(previousContigLength, contigLength)
+    print message + ' (reads ' + '{:+.1f}'.format(readGrowth) + '%, length ' + '{:+.1f}'.format(lengthGrowth) + '%)'
+
+    if contigSetHash == previousContigSetHash:
+        return True
+    return readGrowth <= args['min_growth'] and lengthGrowth <= args['min_growth']
+
+
+
+def getGrowthPercentage(previousValue, value):
+    if previousValue == 0:
+        return 0.0 if value == 0 else 100.0
+    return 100.0 * (value - previousValue) / previousValue
+
+
+
+# Returns the number of contigs, their total length and a hash of the contig
+# set which doesn't depend on contig order or strand.
+def getContigStats(contigsFile):
+    sequences = [sequence for name, sequence in loadFasta(contigsFile)]
+    sequenceHashes = sorted(getSequenceHash(sequence) for sequence in sequences)
+    contigSetHash = hashlib.md5(''.join(sequenceHashes)).hexdigest()
+    return len(sequences), sum(len(sequence) for sequence in sequences), contigSetHash
+
+
+
+def getIterationContigsFile(iteration):
+    global commands
+    return getIterationDirectoryFullPath(iteration) + os.path.basename(commands['assemble_contigs'])
+
+
+
+# Each iteration directory has a checkpoint manifest which records, for each
+# completed stage, a key and the fingerprints of the files the stage made.
+# The key is a hash of the stage's command and the fingerprints of its input
+# files, so a re-run or resumed run reuses any stage whose key and files
+# still match.  A stage which doesn't match is cleared and run again, and
+# since its output files then change, so do the keys of the stages after it.
+# The thread count and memory aren't part of any key, as they don't change
+# the results.
+def getIndexStageKey(iteration, iterDir):
+    global args
+    global commands
+    global lastContigsFile
+
+    inputFiles = [args['t']]
+    if iteration > 1:
+        inputFiles.append(lastContigsFile)
+    if args['delta_index'] and iteration > 1:
+        inputFiles.append(getIterationDirectoryFullPath(iteration - 1) + 'indexed_sequences.fasta')
+    if args['frontier'] > 0 and iteration > 1:
+        inputFiles.append(getIterationDirectoryFullPath(iteration - 1) + 'frontier_ends.txt')
+
+    command = replacePartOfCommand(commands['index'], 'REFERENCE_FILES', ','.join(inputFiles[:2]))
+    command = replacePartOfCommand(command, 'INDEX', iterDir + '/1_mapping_index/bowtie2index')
+    settings = {'delta_index': args['delta_index'], 'frontier': args['frontier'],
+                'compact': args['compact'], 'min_contig_length': args['min_contig_length']}
+    return getStageKey('index', command, inputFiles, settings)
+
+
+def getMappingStageKey(iteration, iterDir, indexKey):
+    global args
+    global commands
+    global mappingReadFiles
+
+    inputFiles = [mappingReadFiles[readType] for readType in ('1', '2', 'u')]
+    if iteration > 1:
+        previousIterDir = getIterationDirectoryFullPath(iteration - 1)
+        inputFiles += getFilteredReadsFiles(previousIterDir)
+        if args['read_index']:
+            inputFiles += glob.glob(previousIterDir + 'recruited_*.bitmap')
+
+    command = [getIterationCommand('map_paired', iteration), getIterationCommand('map_unpaired', iteration)]
+    settings = {'index': indexKey}
+    for option in ('prefilter', 'seed_length', 'stream_filter', 'read_index', 'compress', 'skip_recruited'):
+        settings[option] = args[option]
+    return getStageKey('mapping', command, inputFiles, settings)
+
+
+# A reused assembly depends on the previous iteration's assembly rather than
+# the assembly command.  An assembly command which is given the previous
+# assembly's files depends on them too.
+def getAssemblyStageKey(iteration, iterDir, readsUnchanged):
+    global args
+    global commands
+
+    inputFiles = getFilteredReadsFiles(iterDir)
+    if readsUnchanged:
+        command = 'reuse previous assembly'
+        inputFiles.append(getIterationContigsFile(iteration - 1))
+    else:
+        command = getAssemblyCommand(iteration, iterDir, 'THREADS', 'MEMORY')
+        inputFiles += [fileName for placeholder, fileName in sorted(getPreviousAssemblyFiles(iteration).items())
+                       if fileName is not None and any(fileName in line for line in command)]
+    settings = {'contigs': commands['assemble_contigs'], 'graph': commands.get('assemble_graph', ''),
+                'normalise': args['normalise'], 'normalise_k': args['normalise_k']}
+    return getStageKey('assembly', command, inputFiles, settings)
+
+
+def getStageKey(stageName, command, inputFiles, settings):
+    inputFingerprints = [(inputFile, getFileFingerprint(inputFile)) for inputFile in inputFiles if inputFile != None]
+    keyParts = [stageName, command, inputFingerprints, settings]
+    return hashlib.sha1(json.dumps(keyParts, sort_keys=True)).hexdigest()
+
+
+# Small files are fingerprinted by their contents, so an identical file made
+# again (like an unchanged assembly) keeps its fingerprint.  Hashing large
+# files, like the input reads, would take too long, so their size and
+# modification time are used instead.
+def getFileFingerprint(fileName):
+    if os.path.isdir(fileName):
+        return [(name, getFileFingerprint(os.path.join(fileName, name))) for name in sorted(os.listdir(fileName))]
+    if not os.path.isfile(fileName):
+        return None
+
+    fileSize = os.path.getsize(fileName)
+    if fileSize > 16777216:
+        return str(fileSize) + ':' + repr(os.path.getmtime(fileName))
+
+    fileHash = hashlib.md5()
+    hashedFile = open(fileName, 'rb')
+    for block in iter(lambda: hashedFile.read(1048576), ''):
+        fileHash.update(block)
+    hashedFile.close()
+    return fileHash.hexdigest()
+
+
+# Returns a stage's files (which must be unchanged for its checkpoint to be
+# valid) and its working files and directories (which are deleted along the
+# way, so they don't count).  Both are cleared before the stage is run.
+def getStageFiles(iterDir, stageName):
+    global commands
+
+    if stageName == 'index':
+        return ['1_mapping_index', 'indexed_sequences.fasta', 'frontier_ends.txt'], []
+    if stageName == 'mapping':
+        stageFiles = [os.path.basename(fileName) for fileName in glob.glob(iterDir + '/filtered_reads_*')]
+        stageFiles += [os.path.basename(fileName) for fileName in glob.glob(iterDir + '/recruited_*.bitmap')]
+        workingFiles = [os.path.basename(fileName) for fileName in glob.glob(getWorkingDirectory(iterDir) + '/unrecruited_reads_*')]
+        return stageFiles, workingFiles + ['0_prefilter', '2-paired_read_alignments', '2-unpaired_read_alignments', '2-read_chunks']
+
+    stageFiles = [os.path.basename(commands['assemble_contigs'])]
+    if 'assemble_graph' in commands and commands['assemble_graph'] != "":
+        stageFiles.append(os.path.basename(commands['assemble_graph']))
+    return stageFiles, ['2-normalised_reads', '3-assembly']
+
+
+# Intermediate files are in the working directory, which may be on scratch.
+def getStageFilePath(iterDir, fileName):
+    if fileName in intermediateDirectories or fileName.startswith('unrecruited_reads_'):
+        return getWorkingDirectory(iterDir) + '/' + fileName
+    return iterDir + '/' + fileName
+
+
+def loadCheckpoints(iterDir):
+    checkpointsFile = iterDir + '/checkpoints.json'
+    if not os.path.isfile(checkpointsFile):
+        return {}
+    try:
+        return json.load(open(checkpointsFile, 'r'))
+    except ValueError:
+        return {}
+
+
+# The manifest is replaced in a single rename, so a run which is killed never
+# leaves a partly written one behind.
+def saveCheckpoints(iterDir, checkpoints):
+    checkpointsFile = iterDir + '/checkpoints.json'
+    temporaryFile = checkpointsFile + '.tmp'
+    checkpointsOutput = open(temporaryFile, 'w')
+    json.dump(checkpoints, checkpointsOutput, sort_keys=True, indent=1)
+    checkpointsOutput.close()
+    os.rename(temporaryFile, checkpointsFile)
+
+
+def isStageCheckpointed(iterDir, stageName, stageKey):
+    global args
+
+    if args['no_checkpoints']:
+        return False
+    checkpoint = loadCheckpoints(iterDir).get(stageName)
+    if checkpoint is None or checkpoint['key'] != stageKey:
+        return False
+    for fileName, fingerprint in checkpoint['files'].items():
+        if json.loads(json.dumps(getFileFingerprint(getStageFilePath(iterDir, fileName)))) != fingerprint:
+            return False
+    return True
+
+
+# Forgets a stage's checkpoint (before anything is deleted, in case the run
+# is killed part way) and deletes the files it made.
+def clearStage(iterDir, stageName):
+    if stageName == 'mapping':
+        recruitedReadCounts.pop(iterDir + '/', None)
+
+    checkpoints = loadCheckpoints(iterDir)
+    if stageName in checkpoints:
+        del checkpoints[stageName]
+        saveCheckpoints(iterDir, checkpoints)
+
+    stageFiles, workingFiles = getStageFiles(iterDir, stageName)
+    for fileName in stageFiles + workingFiles:
+        path = getStageFilePath(iterDir, fileName)
+        if os.path.isdir(path):
+            shutil.rmtree(path)
+        elif os.path.exists(path):
+            os.remove(path)
+
+
+# The state is anything the stage sets up for later stages, which has to be
+# restored when the stage is reused.
+def saveStageCheckpoint(iterDir, stageName, stageKey, state=None):
+    global args
+
+    if args['no_checkpoints']:
+        return
+    stageFiles = getStageFiles(iterDir, stageName)[0]
+    checkpoints = loadCheckpoints(iterDir)
+    checkpoints[stageName] = {'key': stageKey,
+                              'files': dict((fileName, getFileFingerprint(getStageFilePath(iterDir, fileName)))
+                                            for fileName in stageFiles if os.path.exists(getStageFilePath(iterDir, fileName))),
+                              'state': state}
+    saveCheckpoints(iterDir, checkpoints)
+
+
+def restoreIndexState(iterDir):
+    global mappingIndex
+    global mappingReference
+
+    state = loadCheckpoints(iterDir)['index']['state']
+    mappingIndex = state['index']
+    mappingReference = state['reference']
+
+
+
+# Each stage of each iteration adds one JSON line to metrics.jsonl in the
+# output directory.  A stage's record covers the child processes it started
+# (their CPU time and peak memory come from wait4) as well as Irsat's own
+# work, which matters for stages like carry-forward that run in Python.
+# Irsat's own CPU time covers the whole process, so it includes any stage
+# running at the same time in another thread.
+def startStageMetrics(iteration, stageName, inputFiles):
+    selfUsage = resource.getrusage(resource.RUSAGE_SELF)
+    metrics = {'iteration': iteration,
+               'stage': stageName,
+               'start': getDateTimeString(),
+               'startTime': time.time(),
+               'selfUserTime': selfUsage.ru_utime,
+               'selfSystemTime': selfUsage.ru_stime,
+               'inputBytes': getTotalFileSize(inputFiles),
+               'processes': []}
+    if diskBudget is not None:
+        metrics['diskWaitSeconds'] = diskBudget.startStage(metrics['inputBytes'])
+    currentStage.metrics = metrics
+    return metrics
+
+
+def finishStageMetrics(metrics, outputFiles, extraMetrics=None):
+    global outDir
+
+    for process in metrics['processes']:
+        if process.returncode is None:
+            process.wait()
+    childUsages = [process.rusage for process in metrics['processes'] if process.rusage is not None]
+    selfUsage = resource.getrusage(resource.RUSAGE_SELF)
+
+    record = collections.OrderedDict()
+    record['iteration'] = metrics['iteration']
+    record['stage'] = metrics['stage']
+    record['start'] = metrics['start']
+    record['wall_seconds'] = round(time.time() - metrics['startTime'], 3)
+    record['child_processes'] = len(metrics['processes'])
+    record['child_user_seconds'] = round(sum(usage.ru_utime for usage in childUsages), 3)
+    record['child_system_seconds'] = round(sum(usage.ru_stime for usage in childUsages), 3)
+    record['child_peak_rss_kb'] = max([usage.ru_maxrss for usage in childUsages] + [0])
+    record['irsat_user_seconds'] = round(selfUsage.ru_utime - metrics['selfUserTime'], 3)
+    record['irsat_system_seconds'] = round(selfUsage.ru_stime - metrics['selfSystemTime'], 3)
+    record['irsat_peak_rss_kb'] = selfUsage.ru_maxrss
+    record['input_bytes'] = metrics['inputBytes']
+    record['output_bytes'] = getTotalFileSize(outputFiles)
+    if 'diskWaitSeconds' in metrics:
+        record['disk_wait_seconds'] = round(metrics['diskWaitSeconds'], 3)
+    if extraMetrics is not None:
+        record.update(extraMetrics)
+
+    if getattr(currentStage, 'metrics', None) is metrics:
+        currentStage.metrics = None
+    if diskBudget is not None:
+        diskBudget.finishStage()
+
+    metricsLock.acquire()
+    try:
+        metricsFile = open(outDir + '/metrics.jsonl', 'a')
+        metricsFile.write(json.dumps(record) + '\n')
+        metricsFile.close()
+    finally:
+        metricsLock.release()
+
+
+# Runs a function as a measured stage.  If the function splits its stage,
+# the output files belong to the last part.
+def runMeasuredStage(iteration, stageName, inputFiles, outputFiles, function, arguments):
+    startStageMetrics(iteration, stageName, inputFiles)
+    try:
+        function(*arguments)
+        finishStageMetrics(currentStage.metrics, outputFiles)
+    finally:
+        abandonStageMetrics()
+
+
+# A stage which fails doesn't finish its metrics, but it still has to give
+# back its place in the disk budget.  Stages call this when they end for any
+# reason; it does nothing for a stage which was finished.
+def abandonStageMetrics():
+    if getattr(currentStage, 'metrics', None) is not None:
+        currentStage.metrics = None
+        if diskBudget is not None:
+            diskBudget.finishStage()
+
+
+# Ends the current thread's stage and starts the next, for functions which
+# run more than one stage.  The files passed to the split are the outputs of
+# the first stage and the inputs of the second.
+def splitStageMetrics(nextStageName, splitFiles):
+    metrics = currentStage.metrics
+    if metrics is None:
+        return
+    finishStageMetrics(metrics, splitFiles)
+    startStageMetrics(metrics['iteration'], nextStageName, splitFiles)
+
+
+def getAssemblyMetrics(contigsFile, reused):
+    contigLengths = [len(sequence) for name, sequence in loadFasta(contigsFile)]
+    assemblyMetrics = collections.OrderedDict()
+    assemblyMetrics['reused'] = reused
+    assemblyMetrics['contigs'] = len(contigLengths)
+    assemblyMetrics['contig_length'] = sum(contigLengths)
+    assemblyMetrics['contig_n50'] = getN50(contigLengths)
+    return assemblyMetrics
+
+
+
+def getN50(lengths):
+    halfTotal = sum(lengths) / 2.0
+    runningTotal = 0
+    for length in sorted(lengths, reverse=True):
+        runningTotal += length
+        if runningTotal >= halfTotal:
+            return length
+    return 0
+
+
+
+def deleteTemporaryDirectories(iterDir, directoryNames=intermediateDirectories):
+    workingDir = getWorkingDirectory(iterDir)
+    for directoryName in directoryNames:
+        if os.path.exists(workingDir + '/' + directoryName):
+            shutil.rmtree(workingDir + '/' + directoryName)
+
+
+# Intermediate files inside a stage are deleted as soon as the step which
+# reads them is done, unless they are being kept.
+def deleteIntermediateFiles(fileNames):
+    global args
+
+    if args['keep']:
+        return
+    for fileName in fileNames:
+        if os.path.isfile(fileName):
+            os.remove(fileName)
 
 
 
@@ -582,6 +3593,559 @@ def printFinishedMessage(duration):
 
 
 
+# Loads a FASTA file into a list of (name, sequence) tuples.
+def loadFasta(fastaFile):
+    sequences = []
+    name = ''
+    sequenceParts = []
+    for line in openReadFile(fastaFile):
+        line = line.strip()
+        if len(line) == 0:
+            continue
+        if line[0] == '>':
+            if name != '':
+                sequences.append((name, ''.join(sequenceParts)))
+            name = line[1:]
+            sequenceParts = []
+        else:
+            sequenceParts.append(line.upper())
+    if name != '':
+        sequences.append((name, ''.join(sequenceParts)))
+    return sequences
+
+
+# Reads a FASTQ file in large batches.  Each batch is a list of records and
+# each record is a tuple of its four lines (newlines included).  Input read
+# files in the read store are unpacked from the store instead.
+def readFastqBatches(fastqFile, batchSize=100000):
+    storedFile = readStore.get(os.path.abspath(fastqFile))
+    if storedFile is not None:
+        for start in range(0, storedFile['count'], batchSize):
+            yield getStoredRecords(storedFile, start, min(start + batchSize, storedFile['count']))
+        return
+
+    fastq = openReadFile(fastqFile)
+    while True:
+        lines = list(itertools.islice(fastq, 4 * batchSize))
+        if len(lines) == 0:
+            break
+        yield zip(lines[0::4], lines[1::4], lines[2::4], lines[3::4])
+    fastq.close()
+
+
+def loadArray(arrayFile, typeCode='L'):
+    values = array.array(typeCode)
+    values.fromstring(open(arrayFile, 'rb').read())
+    return values
+
+
+def saveArray(values, arrayFile):
+    output = open(arrayFile, 'wb')
+    values.tofile(output)
+    output.close()
+
+
+# Sorts an array without turning all of it into a Python list at once.
+def sortArrayInChunks(values, chunkSize=1000000):
+    chunks = [array.array('L', sorted(values[i:i+chunkSize])) for i in range(0, len(values), chunkSize)]
+    return array.array('L', heapq.merge(*chunks))
+
+
+# Empty files cannot be memory-mapped, so an empty string stands in for them.
+# Gzipped files aren't mapped at all.
+def memoryMapFile(fileName):
+    if isGzipped(fileName):
+        return None
+    if os.path.getsize(fileName) == 0:
+        return ''
+    openFile = open(fileName, 'rb')
+    return mmap.mmap(openFile.fileno(), 0, access=mmap.ACCESS_READ)
+
+
+def countFastqRecords(fastqFile):
+    lineCount = 0
+    fastq = openReadFile(fastqFile)
+    while True:
+        chunk = fastq.read(1048576)
+        if len(chunk) == 0:
+            break
+        lineCount += chunk.count('\n')
+    fastq.close()
+    return lineCount // 4
+
+
+def isGzipped(fileName):
+    gzipFile = open(fileName, 'rb')
+    magicNumber = gzipFile.read(2)
+    gzipFile.close()
+    return magicNumber == '\x1f\x8b'
+
+
+# Only one character is needed, so a gzipped file is read with Python's gzip
+# module rather than a pigz process which would be stopped early.
+def isFastqFile(fileName):
+    readFile = gzip.open(fileName, 'rb') if isGzipped(fileName) else open(fileName, 'rb')
+    firstCharacter = readFile.read(1)
+    readFile.close()
+    return firstCharacter == '@' or firstCharacter == ''
+
+
+# Opens a file for reading, decompressing it if it is gzipped (which includes
+# bgzip).  A separate pigz process decompresses faster than Python's gzip
+# module and in parallel with Irsat, so it is used when it is installed.
+def openReadFile(fileName):
+    if not isGzipped(fileName):
+        return open(fileName, 'rb', 1048576)
+    if findProgram('pigz') != None:
+        return PipedFile(['pigz', '-dc', fileName], 'r')
+    return gzip.open(fileName, 'rb')
+
+
+# Opens a read file for writing (or appending), compressing it if its name
+# ends in .gz.  Block compression with pigz or bgzip uses several threads, so
+# it doesn't hold up the stage writing the reads.  Appending adds a new gzip
+# member, which gzip readers treat as part of the same file.
+def openReadsForWriting(fileName, mode='w'):
+    global args
+
+    if not fileName.endswith('.gz'):
+        return open(fileName, mode, 1048576)
+
+    compressionThreads = str(max(1, args['threads']))
+    if findProgram('pigz') != None:
+        return PipedFile(['pigz', '-c', '-p', compressionThreads], mode, fileName)
+    if findProgram('bgzip') != None:
+        return PipedFile(['bgzip', '-c', '-@', compressionThreads], mode, fileName)
+    return gzip.open(fileName, mode + 'b', 6)
+
+
+def compressFile(plainFile, compressedFile):
+    compressed = openReadsForWriting(compressedFile)
+    plain = open(plainFile, 'rb')
+    shutil.copyfileobj(plain, compressed, 1048576)
+    plain.close()
+    compressed.close()
+    os.remove(plainFile)
+
+
+def findProgram(program):
+    for directory in os.environ.get('PATH', '').split(os.pathsep):
+        programPath = os.path.join(directory, program)
+        if os.path.isfile(programPath) and os.access(programPath, os.X_OK):
+            return programPath
+    return None
+
+
+# A file-like object for a (de)compression process.  When reading, the lines
+# come from the process's stdout.  When writing, lines go to its stdin and its
+# stdout goes to the named file.
+class PipedFile(object):
+    def __init__(self, command, mode, fileName=None):
+        self.command = command
+        self.outputFile = None
+        self.atEnd = False
+        if mode == 'r':
+            self.process = startLoggedProcess(command, stdout=subprocess.PIPE, bufsize=1048576)
+            self.pipe = self.process.stdout
+        else:
+            self.outputFile = open(fileName, mode + 'b')
+            self.process = startLoggedProcess(command, stdin=subprocess.PIPE, stdout=self.outputFile, bufsize=1048576)
+            self.pipe = self.process.stdin
+
+    def __iter__(self):
+        for line in self.pipe:
+            yield line
+        self.atEnd = True
+
+    def read(self, size=-1):
+        data = self.pipe.read(size)
+        if size < 0 or (size > 0 and len(data) == 0):
+            self.atEnd = True
+        return data
+
+    def readline(self):
+        line = self.pipe.readline()
+        if len(line) == 0:
+            self.atEnd = True
+        return line
+
+    def write(self, data):
+        try:
+            self.pipe.write(data)
+        except IOError as e:
+            if e.errno != errno.EPIPE:
+                raise
+            self.stopForBrokenPipe()
+
+    # A reader which stops early closes the pipe while the process may still
+    # be writing, so the process is allowed to end with a broken pipe.  If the
+    # reader got to the end, the process must have succeeded, or else the
+    # input (like a truncated gzipped file) was only partly read.
+    def close(self):
+        try:
+            self.pipe.close()
+        except IOError as e:
+            if e.errno != errno.EPIPE:
+                raise
+            self.stopForBrokenPipe()
+        if self.outputFile is None and not self.atEnd:
+            self.process.wait()
+            return
+        waitForProcesses([self.process], '\n\nERROR: ' + ' '.join(self.command) + ' failed.')
+        if self.outputFile is not None:
+            self.outputFile.close()
+
+    # A writer's process ended before reading all of its input.  It usually
+    # failed, and waitForProcesses reports that, but even if it exited
+    # cleanly, some of the data is missing.
+    def stopForBrokenPipe(self):
+        failureMessage = '\n\nERROR: ' + ' '.join(self.command) + ' failed.'
+        waitForProcesses([self.process], failureMessage)
+        if not pipelineStopping.is_set():
+            pipelineStopping.set()
+            stopRunningProcesses()
+            print failureMessage + ' (' + os.path.basename(self.command[0]) + ' stopped reading its input, see ' + self.process.logFileName + ')'
+        exit()
+
+
+def saveFasta(sequences, fastaFile):
+    fasta = open(fastaFile, 'w')
+    for name, sequence in sequences:
+        fasta.write('>' + name + '\n')
+        for i in range(0, len(sequence), 70):
+            fasta.write(sequence[i:i+70] + '\n')
+    fasta.close()
+
+
+def getReverseComplement(sequence):
+    return sequence.translate(complementTable)[::-1]
+
+
+# Sequences are hashed without regard to strand, so a contig and its reverse
+# complement give the same hash.
+def getSequenceHash(sequence):
+    reverseComplement = getReverseComplement(sequence)
+    return hashlib.md5(min(sequence, reverseComplement)).hexdigest()
+
+
+
+# This is a Popen which reaps its process with wait4, so the process's
+# resource usage is kept.  It also adds itself to the current thread's stage
+# metrics and to the running processes, so it can be stopped if another
+# stage fails.
+class MeasuredPopen(subprocess.Popen):
+    def __init__(self, *popenArguments, **popenKeywordArguments):
+        self.rusage = None
+        subprocess.Popen.__init__(self, *popenArguments, **popenKeywordArguments)
+        metrics = getattr(currentStage, 'metrics', None)
+        if metrics is not None:
+            metrics['processes'].append(self)
+        with processesLock:
+            runningProcesses.add(self)
+
+    # Like the standard library's methods, these bind the globals they use
+    # as default arguments, as __del__ can poll a process while the
+    # interpreter is shutting down and module globals are already gone.
+    def _handle_exitstatus(self, status, _runningProcesses=runningProcesses, _processesLock=processesLock):
+        subprocess.Popen._handle_exitstatus(self, status)
+        with _processesLock:
+            _runningProcesses.discard(self)
+
+    def wait(self):
+        while self.returncode is None:
+            try:
+                pid, status, self.rusage = os.wait4(self.pid, 0)
+            except OSError as e:
+                if e.errno == errno.EINTR:
+                    continue
+                if e.errno != errno.ECHILD:
+                    raise
+                status = 0
+            self._handle_exitstatus(status)
+        return self.returncode
+
+    def _internal_poll(self, _deadstate=None, _wait4=os.wait4, _WNOHANG=os.WNOHANG, *otherArguments, **otherKeywordArguments):
+        if self.returncode is None:
+            try:
+                pid, status, rusage = _wait4(self.pid, _WNOHANG)
+                if pid == self.pid:
+                    self.rusage = rusage
+                    self._handle_exitstatus(status)
+            except OSError:
+                if _deadstate is not None:
+                    self.returncode = _deadstate
+        return self.returncode
+
+
+# Starts a child process with its stderr, and its stdout unless that goes
+# somewhere else, appended to the current stage's log file.  The output goes
+# straight to the file, so none of it is held in memory.  The child gets its
+# own process group, so any processes it starts (like SPAdes' own stages)
+# can be stopped along with it.
+def startLoggedProcess(command, **popenKeywordArguments):
+    logFileName = getStageLogFile()
+    logFile = open(logFileName, 'a')
+    logFile.write('\n' + getDateTimeString() + '  ' + ' '.join(command) + '\n')
+    logFile.flush()
+    popenKeywordArguments.setdefault('stdout', logFile)
+    try:
+        process = MeasuredPopen(command, stderr=logFile, preexec_fn=os.setpgrp, **popenKeywordArguments)
+    finally:
+        logFile.close()
+    process.command = command
+    process.logFileName = logFileName
+    return process
+
+
+# Logs go in a logs directory in the stage's iteration directory, one per
+# stage.  A task can set its own log file (like a mapping chunk's log), and
+# processes started outside any stage log to OUTDIR/logs/other.log.  Before
+# the output directory is made (while the arguments are checked), there is
+# nowhere to log to, so their output is discarded.
+def getStageLogFile():
+    global outDir
+
+    logFileName = getattr(currentStage, 'logFile', None)
+    if logFileName is None:
+        metrics = getattr(currentStage, 'metrics', None)
+        if metrics is not None:
+            logFileName = getIterationDirectoryFullPath(metrics['iteration']) + 'logs/' + metrics['stage'] + '.log'
+        elif outDir == "":
+            return os.devnull
+        else:
+            logFileName = outDir + '/logs/other.log'
+
+    logDir = os.path.dirname(logFileName)
+    try:
+        os.makedirs(logDir)
+    except OSError as e:
+        if e.errno != errno.EEXIST:
+            raise
+    return logFileName
+
+
+# Waits for processes and checks that they all succeeded.  When one fails,
+# every other running process is stopped, so stages running at the same
+# time fail straight away too, and Irsat exits.  Only the first failure is
+# reported.
+def waitForProcesses(processes, failureMessage):
+    for process in processes:
+        process.wait()
+    failedProcesses = [process for process in processes if process.returncode != 0]
+    if len(failedProcesses) == 0:
+        return
+
+    if not pipelineStopping.is_set():
+        pipelineStopping.set()
+        stopRunningProcesses()
+        failedProcess = failedProcesses[0]
+        print failureMessage + ' (' + os.path.basename(failedProcess.command[0]) + ' exited with ' + str(failedProcess.returncode) + ', see ' + failedProcess.logFileName + ')'
+    exit()
+
+
+def stopRunningProcesses():
+    with processesLock:
+        processes = list(runningProcesses)
+    for process in processes:
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except OSError:
+            pass
+
+
+# Child processes are in their own process groups, so they don't get a
+# Ctrl-C or a kill meant for Irsat.  Irsat stops them itself, and any worker
+# processes, which stop their own.  Workers ignore Ctrl-C, as the main
+# process stops them instead.
+def handleStopSignal(signalNumber, frame):
+    stopRunningProcesses()
+    for workerProcess in multiprocessing.active_children():
+        workerProcess.terminate()
+    os._exit(1)
+
+
+def prepareWorkerProcess():
+    signal.signal(signal.SIGTERM, handleStopSignal)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+
+
+# Python 2 can't interrupt a blocking wait on a thread or a pool with Ctrl-C,
+# so these wait in short steps.
+def getNextResult(resultIterator):
+    while True:
+        try:
+            return resultIterator.next(1.0)
+        except multiprocessing.TimeoutError:
+            pass
+
+
+def joinThread(thread):
+    while thread.is_alive():
+        thread.join(1.0)
+
+
+
+# Splits a number of threads between stages which run at the same time, in
+# proportion to their weights.  Every stage gets at least one thread, so
+# there must be at least as many threads as stages.
+def allocateThreads(totalThreads, weights):
+    if sum(weights) == 0:
+        weights = [1] * len(weights)
+    shares = [float(totalThreads) * weight / sum(weights) for weight in weights]
+    threadCounts = [max(1, int(share)) for share in shares]
+
+    # Hand out (or take back) the remaining threads, largest remainder first.
+    while sum(threadCounts) < totalThreads:
+        i = max(range(len(shares)), key=lambda i: shares[i] - threadCounts[i])
+        threadCounts[i] += 1
+    while sum(threadCounts) > totalThreads:
+        i = max([i for i in range(len(shares)) if threadCounts[i] > 1], key=lambda i: threadCounts[i] - shares[i])
+        threadCounts[i] -= 1
+
+    return threadCounts
+
+
+# Executors run a list of independent tasks and return their results in
+# order.  A task is a module-level function and picklable arguments, and it
+# only communicates through files, so an executor for a batch scheduler could
+# run each task as a job on another node with the same file system.  This is
+# where such an executor would be chosen.
+def getExecutor(workers):
+    return LocalExecutor(workers)
+
+
+# Runs tasks in a pool of worker processes.  A worker process (like a per-
+# target worker) can't start a pool of its own, so there the tasks run one
+# after another.  If isFailure says a task's result is a failure, the tasks
+# still running are stopped (along with their child processes) and the tasks
+# not yet started are skipped.  Their results are None.
+class LocalExecutor(object):
+    def __init__(self, workers):
+        self.workers = workers
+
+    def run(self, function, argumentsList, isFailure=None):
+        results = [None] * len(argumentsList)
+        if self.workers <= 1 or multiprocessing.current_process().daemon:
+            for i, arguments in enumerate(argumentsList):
+                results[i] = function(arguments)
+                if isFailure is not None and isFailure(results[i]):
+                    break
+            return results
+
+        pool = multiprocessing.Pool(self.workers, initializer=prepareWorkerProcess)
+        indexedTasks = [(function, i, arguments) for i, arguments in enumerate(argumentsList)]
+        try:
+            resultIterator = pool.imap_unordered(runIndexedTask, indexedTasks)
+            for task in indexedTasks:
+                i, result = getNextResult(resultIterator)
+                results[i] = result
+                if isFailure is not None and isFailure(result):
+                    pool.terminate()
+                    break
+        except KeyboardInterrupt:
+            pool.terminate()
+            raise
+        finally:
+            pool.close()
+            pool.join()
+        return results
+
+
+def runIndexedTask(indexedTask):
+    function, i, arguments = indexedTask
+    return i, function(arguments)
+
+
+
+
+def concatenateFiles(inputFiles, outputFile):
+    output = open(outputFile, 'wb')
+    for inputFile in inputFiles:
+        inputData = open(inputFile, 'rb')
+        shutil.copyfileobj(inputData, output, 1048576)
+        inputData.close()
+    output.close()
+
+
+# Runs each (function, arguments) pair in its own thread and waits for them
+# all.  The stages spend their time waiting on child processes, so Python
+# threads are enough.  If any stage exits with an error, the other stages'
+# processes are stopped and Irsat exits too.
+def runConcurrently(stages):
+    failedStages = []
+    stageThreads = [threading.Thread(target=runStageInThread, args=(function, arguments, failedStages)) for function, arguments in stages]
+    for stageThread in stageThreads:
+        stageThread.start()
+    for stageThread in stageThreads:
+        joinThread(stageThread)
+    if len(failedStages) > 0:
+        exit(1)
+
+
+# A stage which fails for any reason stops the other stages.  Errors other
+# than the pipeline's own exits are unexpected, so their traceback is shown.
+def runStageInThread(function, arguments, failedStages):
+    try:
+        function(*arguments)
+    except BaseException as error:
+        if not isinstance(error, SystemExit):
+            traceback.print_exc()
+        abandonStageMetrics()
+        failedStages.append(function.__name__)
+        pipelineStopping.set()
+        stopRunningProcesses()
+
+
+# With --disk_limit, a stage waits to start while the space used in the
+# working directory, plus the stage's input size as a guess at what it will
+# write, is over the limit.  It only waits while another stage is running,
+# as that stage's intermediate files are deleted when it is done; with
+# nothing else running, nothing would free any space.  The count of running
+# stages is in shared memory, so stages in worker processes (targets and
+# chunks) share the budget.
+class DiskBudget(object):
+    def __init__(self, directory, limitBytes):
+        self.directory = directory
+        self.limitBytes = limitBytes
+        self.condition = multiprocessing.Condition()
+        self.runningStages = multiprocessing.Value('i', 0, lock=False)
+
+    # Returns the number of seconds the stage waited.
+    def startStage(self, estimatedBytes):
+        waitStartTime = time.time()
+        self.condition.acquire()
+        try:
+            while self.runningStages.value > 0 and getTotalFileSize([self.directory]) + estimatedBytes > self.limitBytes:
+                self.condition.wait(5.0)
+            self.runningStages.value += 1
+        finally:
+            self.condition.release()
+        return time.time() - waitStartTime
+
+    def finishStage(self):
+        self.condition.acquire()
+        try:
+            self.runningStages.value -= 1
+            self.condition.notify_all()
+        finally:
+            self.condition.release()
+
+
+# Directories count as the total size of the files in them and missing files
+# count as nothing.
+def getTotalFileSize(fileNames):
+    totalSize = 0
+    for fileName in fileNames:
+        if fileName == None or fileName == '':
+            continue
+        if os.path.isdir(fileName):
+            for directory, subdirectories, directoryFiles in os.walk(fileName):
+                totalSize += sum(os.path.getsize(os.path.join(directory, directoryFile)) for directoryFile in directoryFiles)
+        elif os.path.isfile(fileName):
+            totalSize += os.path.getsize(fileName)
+    return totalSize
+
+
 def getDateTimeString():
     return datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
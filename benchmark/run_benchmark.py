@@ -0,0 +1,259 @@
+#!/usr/bin/env python
+
+
+# Copyright 2015 Ryan Wick
+
+# This file is part of Irsat.
+
+# Irsat is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+
+# Irsat is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+
+# You should have received a copy of the GNU General Public License along with
+# Irsat.  If not, see <http:# www.gnu.org/licenses/>.
+
+# This script benchmarks Irsat's own overhead.  It simulates datasets of a few
+# sizes, runs Irsat on each with the stand-in mapper and assembler (so no
+# Bowtie 2, Samtools or SPAdes is needed) and reports the time spent in each
+# stage and the peak memory, using Irsat's metrics.jsonl.  The simulated data
+# is the same every time, so saved results can be compared between commits.
+
+from __future__ import print_function
+
+import argparse
+import collections
+import datetime
+import json
+import os
+import shutil
+import subprocess
+import sys
+import time
+
+import simulate_reads
+
+benchmarkDir = os.path.dirname(os.path.abspath(__file__))
+irsatScript = os.path.join(os.path.dirname(benchmarkDir), 'Irsat.py')
+standInDir = os.path.join(benchmarkDir, 'stand_ins')
+
+
+def main():
+    args = getArguments()
+    workDir = os.path.abspath(args.o)
+    if not os.path.exists(workDir):
+        os.makedirs(workDir)
+    configFile = writeStandInConfig(workDir, args.python)
+
+    pairCounts = [int(value) for value in args.pairs.split(',')]
+    iterationCounts = [int(value) for value in args.iterations.split(',')]
+
+    results = collections.OrderedDict()
+    results['commit'] = getGitCommit()
+    results['date'] = datetime.datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+    results['irsat_arguments'] = args.irsat_args
+    results['runs'] = []
+
+    for pairCount in pairCounts:
+        dataDir = makeDataset(workDir, pairCount, args.genome_size)
+        for iterationCount in iterationCounts:
+            for repeat in range(args.repeats):
+                run = runIrsat(workDir, dataDir, configFile, pairCount, iterationCount, repeat, args)
+                results['runs'].append(run)
+                printRun(run)
+
+    printSummary(results['runs'])
+
+    if args.results != None:
+        resultsFile = open(args.results, 'w')
+        json.dump(results, resultsFile, indent=2)
+        resultsFile.close()
+        print('\nResults saved to ' + args.results)
+
+    if args.compare != None:
+        printComparison(json.load(open(args.compare, 'r')), results)
+
+
+def getArguments():
+    parser = argparse.ArgumentParser(description="Benchmark Irsat with simulated reads and stand-in tools")
+    parser.add_argument("-o", metavar="WORKDIR", default="irsat_benchmark",
+                        help="working directory for simulated data and Irsat runs (default: irsat_benchmark)")
+    parser.add_argument("--pairs", default="10000,50000",
+                        help="comma-separated read pair counts to test (default: 10000,50000)")
+    parser.add_argument("--iterations", default="2,4",
+                        help="comma-separated iteration counts to test (default: 2,4)")
+    parser.add_argument("--genome_size", type=int, default=200000,
+                        help="length of the simulated genome (default: 200000)")
+    parser.add_argument("--repeats", type=int, default=1,
+                        help="how many times to run each case (default: 1)")
+    parser.add_argument("--irsat_args", default="",
+                        help="extra Irsat arguments, e.g. \"--prefilter 16 --read_index\"")
+    parser.add_argument("--python", default=sys.executable,
+                        help="the Python interpreter for Irsat and the stand-in tools (default: this one)")
+    parser.add_argument("--results", metavar="JSON",
+                        help="save the results to this file")
+    parser.add_argument("--compare", metavar="JSON",
+                        help="compare against results saved by an earlier run")
+    parser.add_argument("--keep", action="store_true",
+                        help="keep Irsat's output directories")
+    return parser.parse_args()
+
+
+# The stand-in tools are run with the same interpreter as Irsat.  The config
+# mirrors spades.config, so THREADS and the other variables are exercised.
+def writeStandInConfig(workDir, python):
+    index = python + ' ' + os.path.join(standInDir, 'stand_in_index.py')
+    mapper = python + ' ' + os.path.join(standInDir, 'stand_in_mapper.py')
+    assembler = python + ' ' + os.path.join(standInDir, 'stand_in_assembler.py')
+
+    configFile = os.path.join(workDir, 'stand_in.config')
+    config = open(configFile, 'w')
+    config.write('[Mapping]\n')
+    config.write('index: ' + index + ' --threads THREADS REFERENCE_FILES INDEX\n')
+    config.write('paired reads: ' + mapper + ' -p THREADS -x INDEX -1 PAIRED_READS_FILE_1 -2 PAIRED_READS_FILE_2\n')
+    config.write('unpaired reads: ' + mapper + ' -p THREADS -x INDEX -U UNPAIRED_READS_FILE\n')
+    config.write('\n[Assembly]\n')
+    config.write('paired reads: ' + assembler + ' -1 PAIRED_READS_FILE_1 -2 PAIRED_READS_FILE_2 -t THREADS -o DIRECTORY\n')
+    config.write('unpaired reads: ' + assembler + ' -s UNPAIRED_READS_FILE -t THREADS -o DIRECTORY\n')
+    config.write('both: ' + assembler + ' -1 PAIRED_READS_FILE_1 -2 PAIRED_READS_FILE_2 -s UNPAIRED_READS_FILE -t THREADS -o DIRECTORY\n')
+    config.write('contigs: contigs.fasta\n')
+    config.write('graph: assembly_graph.fastg\n')
+    config.close()
+    return configFile
+
+
+# Datasets are only simulated once per size.  There is one unpaired read for
+# every five pairs.
+def makeDataset(workDir, pairCount, genomeSize):
+    dataDir = os.path.join(workDir, 'data_' + str(pairCount) + '_' + str(genomeSize))
+    finishedFlag = os.path.join(dataDir, 'complete')
+    if not os.path.isfile(finishedFlag):
+        print('Simulating ' + str(pairCount) + ' read pairs...')
+        simulate_reads.simulateDataset(dataDir, genomeSize, pairCount, pairCount // 5, 100, 500, 0)
+        open(finishedFlag, 'w').close()
+    return dataDir
+
+
+# Runs Irsat once and returns its timings.  Irsat is reaped with wait4, so its
+# peak memory (and that of the tools it ran) is known even for stages which
+# don't report it.
+def runIrsat(workDir, dataDir, configFile, pairCount, iterationCount, repeat, args):
+    outDir = os.path.join(workDir, 'run_' + str(pairCount) + '_' + str(iterationCount) + '_' + str(repeat))
+    if os.path.exists(outDir):
+        shutil.rmtree(outDir)
+
+    command = [args.python, irsatScript, '-c', configFile, '-t', os.path.join(dataDir, 'target.fasta'),
+               '-o', outDir, '-i', str(iterationCount),
+               '-1', os.path.join(dataDir, 'reads_R1.fastq'), '-2', os.path.join(dataDir, 'reads_R2.fastq'),
+               '-u', os.path.join(dataDir, 'reads_U.fastq'), '--stream_filter'] + args.irsat_args.split()
+
+    logFile = open(outDir + '.log', 'w')
+    startTime = time.time()
+    irsat = subprocess.Popen(command, stdout=logFile, stderr=subprocess.STDOUT)
+    pid, status, usage = os.wait4(irsat.pid, 0)
+    wallTime = time.time() - startTime
+    logFile.close()
+    if status != 0:
+        print('Irsat failed, see ' + outDir + '.log')
+        sys.exit(1)
+
+    stageTimes = collections.OrderedDict()
+    contigLength = 0
+    recruitedReads = 0
+    for line in open(os.path.join(outDir, 'metrics.jsonl'), 'r'):
+        record = json.loads(line)
+        stageTimes[record['stage']] = stageTimes.get(record['stage'], 0.0) + record['wall_seconds']
+        if record['stage'] == 'assembly':
+            contigLength = record['contig_length']
+        if record['stage'] == 'carry_forward':
+            recruitedReads = record['recruited_reads']
+
+    if not args.keep:
+        shutil.rmtree(outDir)
+
+    run = collections.OrderedDict()
+    run['pairs'] = pairCount
+    run['iterations'] = iterationCount
+    run['repeat'] = repeat
+    run['wall_seconds'] = round(wallTime, 3)
+    run['cpu_seconds'] = round(usage.ru_utime + usage.ru_stime, 3)
+    run['peak_rss_kb'] = usage.ru_maxrss
+    run['recruited_reads'] = recruitedReads
+    run['contig_length'] = contigLength
+    run['stage_seconds'] = collections.OrderedDict((stage, round(seconds, 3)) for stage, seconds in stageTimes.items())
+    return run
+
+
+def printRun(run):
+    print(str(run['pairs']) + ' pairs, ' + str(run['iterations']) + ' iterations: ' +
+          '{:.2f}'.format(run['wall_seconds']) + ' s, ' + str(run['peak_rss_kb']) + ' kB peak, ' +
+          str(run['recruited_reads']) + ' reads recruited, ' + str(run['contig_length']) + ' bp assembled')
+
+
+def printSummary(runs):
+    stages = []
+    for run in runs:
+        for stage in run['stage_seconds']:
+            if stage not in stages:
+                stages.append(stage)
+
+    print('\nSeconds per stage (summed over iterations, averaged over repeats):')
+    header = ['pairs', 'iters'] + stages + ['total', 'peak kB']
+    print('\t'.join(header))
+    for pairs, iterations in unique((run['pairs'], run['iterations']) for run in runs):
+        caseRuns = [run for run in runs if run['pairs'] == pairs and run['iterations'] == iterations]
+        row = [str(pairs), str(iterations)]
+        for stage in stages:
+            row.append('{:.2f}'.format(average([run['stage_seconds'].get(stage, 0.0) for run in caseRuns])))
+        row.append('{:.2f}'.format(average([run['wall_seconds'] for run in caseRuns])))
+        row.append(str(max(run['peak_rss_kb'] for run in caseRuns)))
+        print('\t'.join(row))
+
+
+# Compares average wall time and peak memory for the cases in both results.
+def printComparison(baseline, results):
+    print('\nCompared with ' + str(baseline.get('commit')) + ' (' + str(baseline.get('irsat_arguments')) + '):')
+    print('pairs\titers\tbaseline s\tnow s\tratio\tbaseline kB\tnow kB')
+    for pairs, iterations in unique((run['pairs'], run['iterations']) for run in results['runs']):
+        baselineRuns = [run for run in baseline['runs'] if run['pairs'] == pairs and run['iterations'] == iterations]
+        runs = [run for run in results['runs'] if run['pairs'] == pairs and run['iterations'] == iterations]
+        if len(baselineRuns) == 0:
+            continue
+        baselineTime = average([run['wall_seconds'] for run in baselineRuns])
+        time = average([run['wall_seconds'] for run in runs])
+        print('\t'.join([str(pairs), str(iterations), '{:.2f}'.format(baselineTime), '{:.2f}'.format(time),
+                         '{:.2f}'.format(time / baselineTime if baselineTime > 0 else 0.0),
+                         str(max(run['peak_rss_kb'] for run in baselineRuns)), str(max(run['peak_rss_kb'] for run in runs))]))
+
+
+def getGitCommit():
+    try:
+        git = subprocess.Popen(['git', 'rev-parse', '--short', 'HEAD'], cwd=benchmarkDir,
+                               stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        out, err = git.communicate()
+        if git.returncode == 0:
+            return out.decode().strip()
+    except OSError:
+        pass
+    return 'unknown'
+
+
+def unique(values):
+    uniqueValues = []
+    for value in values:
+        if value not in uniqueValues:
+            uniqueValues.append(value)
+    return uniqueValues
+
+
+def average(values):
+    return sum(values) / float(len(values))
+
+
+if __name__ == '__main__':
+    main()
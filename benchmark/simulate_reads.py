@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+
+
+# Copyright 2015 Ryan Wick
+
+# This file is part of Irsat.
+
+# Irsat is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+
+# Irsat is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+
+# You should have received a copy of the GNU General Public License along with
+# Irsat.  If not, see <http:# www.gnu.org/licenses/>.
+
+# This script makes a random reference genome, a target taken from the middle
+# of it and simulated paired and unpaired reads.  Each read's name records
+# where it came from, which is what the stand-in assembler uses to put reads
+# back together.  The same seed always gives the same files.
+
+from __future__ import print_function
+
+import argparse
+import os
+import random
+
+
+def main():
+    args = getArguments()
+    simulateDataset(args.o, args.genome_size, args.pairs, args.unpaired,
+                    args.read_length, args.target_length, args.seed)
+
+
+def getArguments():
+    parser = argparse.ArgumentParser(description="Make a synthetic genome, target and reads for benchmarking Irsat")
+    parser.add_argument("-o", metavar="OUTDIR", required=True,
+                        help="directory for the simulated files")
+    parser.add_argument("--genome_size", type=int, default=200000,
+                        help="length of the random reference (default: 200000)")
+    parser.add_argument("--pairs", type=int, default=10000,
+                        help="number of read pairs (default: 10000)")
+    parser.add_argument("--unpaired", type=int, default=2000,
+                        help="number of unpaired reads (default: 2000)")
+    parser.add_argument("--read_length", type=int, default=100,
+                        help="read length (default: 100)")
+    parser.add_argument("--target_length", type=int, default=500,
+                        help="length of the target, taken from the middle of the reference (default: 500)")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="random seed (default: 0)")
+    return parser.parse_args()
+
+
+# Writes reference.fasta, target.fasta, reads_R1.fastq, reads_R2.fastq and
+# reads_U.fastq to the output directory.
+#   Paired read names: p<number>:<fragment start>:<fragment length>
+#   Unpaired read names: u<number>:<start>:<strand>
+def simulateDataset(outputDir, genomeSize, pairCount, unpairedCount, readLength, targetLength, seed):
+    randomGenerator = random.Random(seed)
+    if not os.path.exists(outputDir):
+        os.makedirs(outputDir)
+
+    genome = ''.join(randomGenerator.choice('ACGT') for i in range(genomeSize))
+    writeFasta(os.path.join(outputDir, 'reference.fasta'), 'reference', genome)
+
+    targetStart = (genomeSize - targetLength) // 2
+    writeFasta(os.path.join(outputDir, 'target.fasta'), 'target', genome[targetStart:targetStart + targetLength])
+
+    qualityCharacters = 'ABCDEFGHI#'
+    fragmentLengths = (readLength * 2 + 50, readLength * 4)
+
+    reads1 = open(os.path.join(outputDir, 'reads_R1.fastq'), 'w')
+    reads2 = open(os.path.join(outputDir, 'reads_R2.fastq'), 'w')
+    for i in range(pairCount):
+        fragmentLength = randomGenerator.randint(fragmentLengths[0], fragmentLengths[1])
+        start = randomGenerator.randint(0, genomeSize - fragmentLength)
+        fragment = genome[start:start + fragmentLength]
+        name = 'p' + str(i) + ':' + str(start) + ':' + str(fragmentLength)
+        qualities1 = ''.join(randomGenerator.choice(qualityCharacters) for j in range(readLength))
+        qualities2 = ''.join(randomGenerator.choice(qualityCharacters) for j in range(readLength))
+        reads1.write('@' + name + '\n' + fragment[:readLength] + '\n+\n' + qualities1 + '\n')
+        reads2.write('@' + name + '\n' + getReverseComplement(fragment[-readLength:]) + '\n+\n' + qualities2 + '\n')
+    reads1.close()
+    reads2.close()
+
+    readsU = open(os.path.join(outputDir, 'reads_U.fastq'), 'w')
+    for i in range(unpairedCount):
+        start = randomGenerator.randint(0, genomeSize - readLength)
+        sequence = genome[start:start + readLength]
+        strand = '+'
+        if randomGenerator.random() < 0.5:
+            sequence = getReverseComplement(sequence)
+            strand = '-'
+        name = 'u' + str(i) + ':' + str(start) + ':' + strand
+        qualities = ''.join(randomGenerator.choice(qualityCharacters) for j in range(readLength))
+        readsU.write('@' + name + '\n' + sequence + '\n+\n' + qualities + '\n')
+    readsU.close()
+
+
+def writeFasta(fastaFile, name, sequence):
+    fasta = open(fastaFile, 'w')
+    fasta.write('>' + name + '\n')
+    for i in range(0, len(sequence), 70):
+        fasta.write(sequence[i:i+70] + '\n')
+    fasta.close()
+
+
+def getReverseComplement(sequence):
+    complements = {'A': 'T', 'C': 'G', 'G': 'C', 'T': 'A', 'N': 'N'}
+    return ''.join(complements[base] for base in reversed(sequence))
+
+
+if __name__ == '__main__':
+    main()
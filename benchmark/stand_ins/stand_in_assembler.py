@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+
+
+# Copyright 2015 Ryan Wick
+
+# This file is part of Irsat.
+
+# Irsat is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+
+# Irsat is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+
+# You should have received a copy of the GNU General Public License along with
+# Irsat.  If not, see <http:# www.gnu.org/licenses/>.
+
+# A stand-in for an assembler, used for benchmarking.  It only works with
+# reads from simulate_reads.py, whose names say where each read came from.
+# Reads are laid out at their positions and each run of covered bases
+# becomes a contig, so the result is deterministic and grows as more reads
+# are recruited.  It writes contigs.fasta and an (empty) assembly_graph.fastg.
+#   Usage: stand_in_assembler.py [-t N] -o DIRECTORY [-1 FILE -2 FILE] [-s FILE]
+
+import gzip
+import os
+import sys
+
+
+def main():
+    arguments = sys.argv[1:]
+    outputDir = getOption(arguments, '-o')
+    if not os.path.exists(outputDir):
+        os.makedirs(outputDir)
+
+    layout = {}
+    for option, mate in (('-1', 1), ('-2', 2), ('-s', 0)):
+        readsFile = getOption(arguments, option)
+        if readsFile != None and os.path.isfile(readsFile):
+            for name, sequence in readFastq(readsFile):
+                addReadToLayout(name, sequence, mate, layout)
+
+    contigs = []
+    positions = sorted(layout)
+    contigStart = 0
+    for i in range(1, len(positions) + 1):
+        if i == len(positions) or positions[i] != positions[i - 1] + 1:
+            contigs.append(''.join(layout[position] for position in positions[contigStart:i]))
+            contigStart = i
+    contigs.sort(key=lambda contig: (-len(contig), contig))
+
+    contigsFile = open(os.path.join(outputDir, 'contigs.fasta'), 'w')
+    for i, contig in enumerate(contigs):
+        contigsFile.write('>NODE_' + str(i + 1) + '_length_' + str(len(contig)) + '\n' + contig + '\n')
+    contigsFile.close()
+    open(os.path.join(outputDir, 'assembly_graph.fastg'), 'w').close()
+
+
+def getOption(arguments, option):
+    if option in arguments:
+        return arguments[arguments.index(option) + 1]
+    return None
+
+
+# Places a read's bases at their reference positions.  Where reads overlap,
+# the first base placed wins.
+def addReadToLayout(name, sequence, mate, layout):
+    nameParts = name.split(':')
+    if name.startswith('p'):
+        fragmentStart = int(nameParts[1])
+        fragmentLength = int(nameParts[2])
+        if mate == 2:
+            start = fragmentStart + fragmentLength - len(sequence)
+            sequence = getReverseComplement(sequence)
+        else:
+            start = fragmentStart
+    else:
+        start = int(nameParts[1])
+        if nameParts[2] == '-':
+            sequence = getReverseComplement(sequence)
+    for i, base in enumerate(sequence):
+        if start + i not in layout:
+            layout[start + i] = base
+
+
+def readFastq(fastqFile):
+    fastq = gzip.open(fastqFile, 'rt') if fastqFile.endswith('.gz') else open(fastqFile, 'r')
+    while True:
+        header = fastq.readline()
+        if header == '':
+            break
+        sequence = fastq.readline().strip()
+        fastq.readline()
+        fastq.readline()
+        name = header[1:].split()[0]
+        if name.endswith('/1') or name.endswith('/2'):
+            name = name[:-2]
+        yield name, sequence
+    fastq.close()
+
+
+def getReverseComplement(sequence):
+    complements = {'A': 'T', 'C': 'G', 'G': 'C', 'T': 'A', 'N': 'N'}
+    return ''.join(complements.get(base, 'N') for base in reversed(sequence))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,44 @@
+#!/usr/bin/env python
+
+
+# Copyright 2015 Ryan Wick
+
+# This file is part of Irsat.
+
+# Irsat is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+
+# Irsat is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+
+# You should have received a copy of the GNU General Public License along with
+# Irsat.  If not, see <http:# www.gnu.org/licenses/>.
+
+# A stand-in for bowtie2-build, used for benchmarking.  The "index" is just
+# the reference sequences copied into INDEX.fasta.
+#   Usage: stand_in_index.py [--threads N] REFERENCE_FILES INDEX
+
+import sys
+
+
+def main():
+    arguments = sys.argv[1:]
+    if arguments[0] == '--threads':
+        arguments = arguments[2:]
+    referenceFiles = arguments[0].split(',')
+    index = arguments[1]
+
+    indexFasta = open(index + '.fasta', 'w')
+    for referenceFile in referenceFiles:
+        for line in open(referenceFile, 'r'):
+            if line.strip() != '':
+                indexFasta.write(line.rstrip('\n') + '\n')
+    indexFasta.close()
+
+
+if __name__ == '__main__':
+    main()
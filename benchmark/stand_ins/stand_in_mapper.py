@@ -0,0 +1,126 @@
+#!/usr/bin/env python
+
+
+# Copyright 2015 Ryan Wick
+
+# This file is part of Irsat.
+
+# Irsat is free software: you can redistribute it and/or modify it under the
+# terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+
+# Irsat is distributed in the hope that it will be useful, but WITHOUT ANY
+# WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE.  See the GNU General Public License for more
+# details.
+
+# You should have received a copy of the GNU General Public License along with
+# Irsat.  If not, see <http:# www.gnu.org/licenses/>.
+
+# A stand-in for Bowtie 2, used for benchmarking.  A read counts as mapped
+# if it shares an exact 20-mer with the index (on either strand), which is
+# roughly what Bowtie 2's seed search needs.  It writes unsorted SAM to
+# stdout with mates next to each other, like Bowtie 2 does.
+#   Usage: stand_in_mapper.py [-p N] -x INDEX (-1 FILE -2 FILE | -U FILE)
+
+import gzip
+import sys
+
+seedLength = 20
+
+
+def main():
+    arguments = sys.argv[1:]
+    index = getOption(arguments, '-x')
+    kmers = loadIndexKmers(index + '.fasta')
+    output = sys.stdout
+
+    output.write('@HD\tVN:1.0\tSO:unsorted\n')
+    if getOption(arguments, '-1') != None:
+        reads1 = readFastq(getOption(arguments, '-1'))
+        reads2 = readFastq(getOption(arguments, '-2'))
+        for (name, sequence1, qualities1), (name2, sequence2, qualities2) in zip(reads1, reads2):
+            mapped1 = isMapped(sequence1, kmers)
+            mapped2 = isMapped(sequence2, kmers)
+            flags1 = 65 | (0 if mapped1 else 4) | (0 if mapped2 else 8)
+            flags2 = 129 | (0 if mapped2 else 4) | (0 if mapped1 else 8)
+            output.write(getSamLine(name, flags1, sequence1, qualities1, mapped1))
+            output.write(getSamLine(name, flags2, sequence2, qualities2, mapped2))
+    else:
+        for name, sequence, qualities in readFastq(getOption(arguments, '-U')):
+            mapped = isMapped(sequence, kmers)
+            output.write(getSamLine(name, 0 if mapped else 4, sequence, qualities, mapped))
+
+    sys.stderr.write('stand-in mapping complete\n')
+
+
+def getOption(arguments, option):
+    if option in arguments:
+        return arguments[arguments.index(option) + 1]
+    return None
+
+
+def loadIndexKmers(indexFasta):
+    sequences = []
+    parts = []
+    for line in open(indexFasta, 'r'):
+        line = line.strip()
+        if line.startswith('>'):
+            if len(parts) > 0:
+                sequences.append(''.join(parts))
+            parts = []
+        elif line != '':
+            parts.append(line.upper())
+    if len(parts) > 0:
+        sequences.append(''.join(parts))
+
+    kmers = set()
+    for sequence in sequences:
+        for strand in (sequence, getReverseComplement(sequence)):
+            for i in range(len(strand) - seedLength + 1):
+                kmers.add(strand[i:i+seedLength])
+    return kmers
+
+
+def isMapped(sequence, kmers):
+    for i in range(len(sequence) - seedLength + 1):
+        if sequence[i:i+seedLength] in kmers:
+            return True
+    return False
+
+
+# Mapped reads are reported on the forward strand, so the sequence is always
+# given as it appears in the read file.
+def getSamLine(name, flags, sequence, qualities, mapped):
+    reference = 'index' if mapped else '*'
+    position = '1' if mapped else '0'
+    return '\t'.join([name, str(flags), reference, position, '42' if mapped else '0',
+                      str(len(sequence)) + 'M' if mapped else '*', '*', '0', '0', sequence, qualities]) + '\n'
+
+
+# Yields (name, sequence, qualities) for each read.  Names lose any /1 or /2
+# suffix, as they do in Bowtie 2's output.
+def readFastq(fastqFile):
+    fastq = gzip.open(fastqFile, 'rt') if fastqFile.endswith('.gz') else open(fastqFile, 'r')
+    while True:
+        header = fastq.readline()
+        if header == '':
+            break
+        sequence = fastq.readline().strip()
+        fastq.readline()
+        qualities = fastq.readline().strip()
+        name = header[1:].split()[0]
+        if name.endswith('/1') or name.endswith('/2'):
+            name = name[:-2]
+        yield name, sequence, qualities
+    fastq.close()
+
+
+def getReverseComplement(sequence):
+    complements = {'A': 'T', 'C': 'G', 'G': 'C', 'T': 'A', 'N': 'N'}
+    return ''.join(complements.get(base, 'N') for base in reversed(sequence))
+
+
+if __name__ == '__main__':
+    main()